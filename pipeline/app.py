@@ -1,10 +1,17 @@
 import json
+import argparse
+from pipeline import config
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', type=int, default=config.WORKERS, help='同时运行的 track 数')
+# 执行器在 import 时创建，所以要先改好配置
+args = parser.parse_args()
+config.WORKERS = args.workers
+
 from pipeline.model import db
 from loguru import logger
 from pipeline.service import create_graph, add_vertex, add_edge, check_graph_all
-import simplejson
-from pipeline.executor import start_pipeline, show_pipeline, finish_params, finish_script, executor
-import time
+from pipeline.executor import start_pipeline, executor
 
 
 # 测试数据
@@ -36,7 +43,10 @@ def create_test_dag():
         # 增加边, abc之间的环
         ba = add_edge(g, b, a)
         ac = add_edge(g, a, c)
-        cb = add_edge(g, c, b)
+        try:
+            cb = add_edge(g, c, b)  # 形成环路的边会被 add_edge 直接拒绝
+        except ValueError as e:
+            logger.info(e)
         bd = add_edge(g, b, d)
 
         # 创建DAG多个终点
@@ -77,53 +87,14 @@ def create_test_dag():
         logger.error(e)
 
 
+# 演示用，会删掉重建所有的表，正式运行执行器用 pipeline.worker
 db.drop_all()
 db.create_all()
 create_test_dag()  # 创建上边的测试数据
 check_graph_all()  # 检查每个流程是否符合 DAG
 
 # 执行一条 Pipeline，并指定使用哪个 Graph，测试数据中有 1-5 号
-start_pipeline(4, "测试1", "这是测试1")
-
-while True:
-    # 找某个 pipeline 中指定状态的 track
-    # 可用状态有：
-    #       STATE_WAITING = 0
-    #       STATE_PENDING = 1
-    #       STATE_RUNNING = 2
-    #       STATE_SUCCEED = 3
-    #       STATE_FAILED = 4
-    #       STATE_FINISH = 5
-    ps = show_pipeline(1, [0,1,2,3,4,5])  # pipeline.id, track；
-    d = {}
-
-    for p in ps:  # 可能多个 track
-        pipeline_id, pipeline_name, pipeline_state, track_id, track_state, vertex_id, vertex_name, vertex_input, vertex_script = p
-        if vertex_input:
-            try:
-                inp = simplejson.loads(vertex_input)
-                if not isinstance(inp, dict):
-                    inp = {}
-            except:
-                raise
-
-            # input     {'ip': {'type': 'str', 'required': True, 'default': '192.168.0.100'}}
-            # script    {'script': 'echo "test1.A"\nping {ip} -c 2', 'next': 'B'}
-            for k, v in inp.items():
-                if v.get('required!!!', False) is True:
-                    params = input(f'{k} = ')
-                else:
-                    params = v.get('default', '127.0.0.1')
-                d[k] = params
-        else:
-            inp = {}
-            d = {}
-
-        # d {'ip': '192.168.0.100'}
-        # 准备好参数       返回值 params: {'ip': '192.168.0.100'}
-        params = finish_params(track_id, d, inp)
-        # 生成替换好的脚本，同时存到 track 库     返回值  script:  echo "test1.A"\nping 192.168.0.100
-        script = finish_script(track_id, vertex_script, params)
+p = start_pipeline(4, "测试1", "这是测试1")
 
-        executor.executor(track_id)
-    time.sleep(2)
+# 把入度为 0 的 track 交给调度器，后续的 track 在前置全部成功后由执行器自动调度
+executor.load_pipeline(p.id)
@@ -0,0 +1,187 @@
+from pipeline.model import db, Pipeline, Track, Blob, STATE_NAMES
+from pipeline.blob import encode, store
+from pipeline.events import hub
+from pipeline import config
+from pipeline import metrics
+from pipeline.profiler import profiled
+from sqlalchemy import bindparam
+from loguru import logger
+from collections import OrderedDict, deque
+import threading
+import queue
+import time
+
+FLUSH_SECONDS = metrics.histogram('pipeline_batcher_flush_seconds', '状态批量写库一次的耗时')
+FLUSH_ROWS = metrics.counter('pipeline_batcher_rows_total', '批量写库的行数（合并后）')
+FLUSH_ERRORS = metrics.counter('pipeline_batcher_errors_total', '批量写库失败的次数（包括重试）')
+FLUSH_DROPPED = metrics.counter('pipeline_batcher_dropped_total', '重试后仍然失败、丢弃的修改数')
+
+
+class StateBatcher:
+    """
+    状态变化的合并写入器（write-behind）
+    各个线程只把要修改的字段放入队列，由单独的线程每 interval 毫秒或者攒够 max_rows 行，合成一个事务批量 UPDATE
+    只有一个线程按入队顺序写，所以同一个 track 的状态变化顺序不会乱
+    写库成功后把状态变化发布给订阅了这个 pipeline 的人（SSE），推送的状态和数据库一致
+    track 的 output 不是列，写库前压缩存入 blob 表，track 中只写 output_digest
+    pipeline 的计数列是增量，同一批中的增量相加，用 col = col + n 更新，多个执行器同时改也不会乱
+    写库失败时回滚后等一会儿重试同一批，重试期间不取新的修改，顺序不会乱，重试次数用完才丢弃
+    """
+
+    MODELS = {'track': Track, 'pipeline': Pipeline}
+
+    def __init__(self, interval_ms=config.BATCH_INTERVAL_MS, max_rows=config.BATCH_MAX_ROWS,
+                 retries=config.BATCH_RETRIES, backoff_ms=config.BATCH_RETRY_BACKOFF_MS):
+        self._interval = interval_ms / 1000
+        self._max_rows = max_rows
+        self._retries = retries
+        self._backoff = backoff_ms / 1000
+        self._queue = queue.Queue()
+        self.flush_latency = deque(maxlen=1000)  # 最近每次写入的耗时，秒
+        self.batch_sizes = deque(maxlen=1000)  # 最近每次写入的行数（合并后）
+        self.flushes = 0
+        self.rows = 0
+        metrics.gauge('pipeline_batcher_pending', '等待写库的修改数', fn=self._queue.qsize)
+        hub.attach()  # 本进程的 SSE 直接接收推送，不用轮询数据库
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def update_track(self, track_id, topic=None, **values):
+        """ topic 是 track 所属的 pipeline.id，状态变化会发布给订阅了它的人 """
+        self._queue.put(('track', track_id, values, topic))
+
+    def update_pipeline(self, pipeline_id, **values):
+        self._queue.put(('pipeline', pipeline_id, values, pipeline_id))
+
+    def count_pipeline(self, pipeline_id, **deltas):
+        """ pipeline 计数列的增量，count_pipeline(1, tracks_pending=-1, tracks_running=1) """
+        self._queue.put(('count', pipeline_id, deltas, None))
+
+    def flush(self, timeout=None):
+        """阻塞到之前放入的修改全部写入数据库"""
+        done = threading.Event()
+        self._queue.put(('flush', None, done, None))
+        return done.wait(timeout)
+
+    def stats(self):
+        latency = list(self.flush_latency)
+        sizes = list(self.batch_sizes)
+        return {
+            'flushes': self.flushes,
+            'rows': self.rows,
+            'pending': self._queue.qsize(),
+            'latency_avg': sum(latency) / len(latency) if latency else 0,
+            'latency_max': max(latency, default=0),
+            'batch_avg': sum(sizes) / len(sizes) if sizes else 0,
+            'batch_max': max(sizes, default=0),
+        }
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]  # 阻塞在这等第一条
+            deadline = time.monotonic() + self._interval
+            while len(items) < self._max_rows and items[-1][0] != 'flush':
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            waiters = [item[2] for item in items if item[0] == 'flush']
+            try:
+                self._write([item for item in items if item[0] != 'flush'])
+            except Exception as e:  # 这个线程退出了 flush() 会永远等下去，什么错误都不能让它退出
+                logger.exception(e)
+            finally:
+                for done in waiters:
+                    done.set()
+
+    @profiled('batcher_flush')
+    def _write(self, items):
+        if not items:
+            return
+
+        # 同一行的多次修改按顺序合并，后边的覆盖前边的
+        merged = OrderedDict()
+        topics = {}
+        counts = OrderedDict()  # pipeline.id -> {计数列: 增量}
+        for kind, row_id, values, topic in items:
+            if kind == 'count':
+                deltas = counts.setdefault(row_id, {})
+                for k, n in values.items():
+                    deltas[k] = deltas.get(k, 0) + n
+                continue
+            merged.setdefault((kind, row_id), {}).update(values)
+            if topic is not None:
+                topics[(kind, row_id)] = topic
+
+        # 输出在写库线程中压缩，同一批中相同的输出只压缩、只存一次
+        outputs = {key: values.pop('output') for key, values in merged.items()
+                   if key[0] == 'track' and 'output' in values}
+        digests, blobs = encode(outputs)
+        for key, d in digests.items():
+            merged[key]['output_digest'] = d
+
+        # 修改的字段相同的行，用一条 UPDATE 语句批量执行
+        groups = OrderedDict()
+        for (kind, row_id), values in merged.items():
+            keys = tuple(sorted(values))
+            row = {'_' + k: v for k, v in values.items()}
+            row['_id'] = row_id
+            groups.setdefault((kind, keys), []).append(row)
+
+        increments = OrderedDict()  # 增量的列相同的行一起执行
+        for row_id, deltas in counts.items():
+            deltas = {k: n for k, n in deltas.items() if n}
+            if deltas:
+                row = {'_' + k: n for k, n in deltas.items()}
+                row['_id'] = row_id
+                increments.setdefault(tuple(sorted(deltas)), []).append(row)
+
+        start = time.perf_counter()
+        for attempt in range(self._retries + 1):
+            try:
+                self._execute(blobs, groups, increments)
+                break
+            except Exception as e:
+                logger.error(e)
+                db.session.rollback()  # 整批在一个事务中，回滚后重试不会重复加计数
+                FLUSH_ERRORS.inc()
+                if attempt < self._retries:
+                    time.sleep(self._backoff * 2 ** attempt)
+        else:
+            logger.error(f'批量写库重试 {self._retries} 次仍然失败，丢弃 {len(items)} 个修改')
+            FLUSH_DROPPED.inc(len(items))
+            return
+
+        elapsed = time.perf_counter() - start
+        FLUSH_SECONDS.observe(elapsed)
+        FLUSH_ROWS.inc(len(merged))
+        self.flush_latency.append(elapsed)
+        self.batch_sizes.append(len(merged))
+        self.flushes += 1
+        self.rows += len(merged)
+        self._publish(merged, topics)
+
+    def _execute(self, blobs, groups, increments):
+        store(db.session, Blob.__table__, blobs)  # 先写 blob，track 引用的内容一定存在
+        for (kind, keys), rows in groups.items():
+            table = self.MODELS[kind].__table__
+            stmt = table.update().where(table.c.id == bindparam('_id')) \
+                .values({k: bindparam('_' + k) for k in keys})
+            db.session.execute(stmt, rows)
+        table = Pipeline.__table__
+        for keys, rows in increments.items():
+            stmt = table.update().where(table.c.id == bindparam('_id')) \
+                .values({k: table.c[k] + bindparam('_' + k) for k in keys})
+            db.session.execute(stmt, rows)
+        db.session.commit()
+
+    @staticmethod
+    def _publish(merged, topics):
+        """ 合并后的最终状态，同一批中 RUNNING 又 SUCCEED 的只推送 SUCCEED """
+        for (kind, row_id), topic in topics.items():
+            state = merged[(kind, row_id)].get('state')
+            if state is not None:
+                hub.publish(topic, {'type': kind, 'id': row_id, 'state': STATE_NAMES.get(state, state)})
@@ -0,0 +1,96 @@
+from pipeline import config
+from loguru import logger
+import hashlib
+import zlib
+
+"""
+track 输出的压缩存储，放在单独的 blob 表中，track 表只存内容的 sha256
+相同的输出只存一份，读取时按块解压，可以边解压边返回
+默认 zlib，config.BLOB_CODEC = 'zstd' 并且安装了 zstandard 时使用 zstd
+"""
+
+CHUNK_SIZE = 64 * 1024
+_warned = False  # 没有安装 zstandard 的警告只打印一次
+
+
+def digest(data: bytes):
+    """ 按原始内容计算，和压缩方式无关 """
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data: bytes, codec=None):
+    """ 返回 (codec, 压缩后的内容) """
+    global _warned
+    codec = codec or config.BLOB_CODEC
+    if codec == 'zstd':
+        try:
+            import zstandard  # 只有使用 zstd 时才需要安装
+            return 'zstd', zstandard.ZstdCompressor(level=config.BLOB_LEVEL).compress(data)
+        except ImportError:
+            if not _warned:
+                logger.warning('没有安装 zstandard，使用 zlib 压缩')
+                _warned = True
+    return 'zlib', zlib.compress(data, config.BLOB_LEVEL)
+
+
+def decompress_stream(codec, payload: bytes, chunk_size=CHUNK_SIZE):
+    """ 按块解压，返回 bytes 的迭代器，不会一次在内存中展开整个输出 """
+    if codec == 'zstd':
+        import zstandard
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        decompressor = zlib.decompressobj()
+    for start in range(0, len(payload), chunk_size):
+        chunk = decompressor.decompress(payload[start:start + chunk_size])
+        if chunk:
+            yield chunk
+    rest = decompressor.flush()
+    if rest:
+        yield rest
+
+
+def decompress(codec, payload: bytes):
+    return b''.join(decompress_stream(codec, payload))
+
+
+def encode(texts: dict):
+    """ {key: 输出文本} -> ({key: digest}, [blob 表的行])，相同的内容只压缩一次 """
+    digests = {}
+    rows = {}
+    for key, text in texts.items():
+        if text is None:
+            digests[key] = None
+            continue
+        data = text.encode()
+        d = digest(data)
+        digests[key] = d
+        if d not in rows:
+            codec, payload = compress(data)
+            rows[d] = {'digest': d, 'codec': codec, 'size': len(data), 'data': payload}
+    return digests, list(rows.values())
+
+
+def store(session, table, rows):
+    """ 写入 blob 表，已经有的内容跳过（去重），多个进程同时写同一个内容也不会冲突 """
+    if not rows:
+        return
+    existing = {d for d, in session.execute(table.select().with_only_columns([table.c.digest])
+                                            .where(table.c.digest.in_([row['digest'] for row in rows])))}
+    rows = [row for row in rows if row['digest'] not in existing]
+    if rows:
+        stmt = table.insert().prefix_with('IGNORE', dialect='mysql').prefix_with('OR IGNORE', dialect='sqlite')
+        session.execute(stmt, rows)
+
+
+def load_stream(session, table, d, chunk_size=CHUNK_SIZE):
+    """ 按 digest 读取，返回解压后 bytes 的迭代器，没有这个内容返回 None """
+    row = session.execute(table.select().with_only_columns([table.c.codec, table.c.data])
+                          .where(table.c.digest == d)).first()
+    if row is None:
+        return None
+    return decompress_stream(row[0], row[1], chunk_size)
+
+
+def load_text(session, table, d):
+    stream = load_stream(session, table, d) if d else None
+    return b''.join(stream).decode(errors='replace') if stream is not None else None
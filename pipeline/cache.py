@@ -0,0 +1,68 @@
+from pipeline import config
+from collections import OrderedDict
+import simplejson
+import hashlib
+import threading
+import time
+
+"""
+按内容寻址的运行结果缓存
+填充好参数的脚本、参数值和顶点声明的 cache_key 相同，运行结果就认为相同，命中时不再启动进程
+只有 script 中声明了 "cacheable": true 的顶点才使用，只缓存成功的结果
+"""
+
+
+def result_key(script: str, params: dict, cache_key=None):
+    """ 结果的内容地址 """
+    h = hashlib.sha256()
+    h.update(script.encode())
+    h.update(b'\0')
+    h.update(simplejson.dumps(params, sort_keys=True).encode())
+    h.update(b'\0')
+    h.update(simplejson.dumps(cache_key, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """ LRU 加过期时间，超过 maxsize 淘汰最久没用的，超过 ttl 秒的当作没有 """
+
+    def __init__(self, maxsize=config.RESULT_CACHE_SIZE, ttl=config.RESULT_CACHE_TTL):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._cache = OrderedDict()  # key -> (存入的时间, 退出码, 输出)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ 返回 (退出码, 输出)，没有或者过期返回 None """
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            stored_at, code, output = item
+            if time.monotonic() - stored_at > self._ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return code, output
+
+    def put(self, key, code, output):
+        with self._lock:
+            self._cache[key] = (time.monotonic(), code, output)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """ 清掉一个，key 为 None 时全部清掉 """
+        with self._lock:
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+# 全局的运行结果缓存
+results = ResultCache()
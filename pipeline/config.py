@@ -7,3 +7,85 @@ PARAMS = "charset=utf8mb4"
 URL = f'mysql+pymysql://{USER}:{PASSWD}@{HOST}/{DATABASE}?{PARAMS}'
 
 DATABASE_DEBUG = False
+
+# 连接池，执行器的线程和 WEB 请求各自从池中取连接
+POOL_SIZE = 10  # 池中保持的连接数
+POOL_MAX_OVERFLOW = 20  # 池满后最多还能临时创建多少连接
+POOL_RECYCLE = 3600  # 连接使用多少秒后回收，要小于 MySQL 的 wait_timeout
+POOL_PRE_PING = True  # 取连接时先 ping 一下，避免拿到已经断开的连接
+
+TOPOLOGY_CACHE_SIZE = 128  # 缓存多少个编译后的图结构
+PLAN_CACHE_SIZE = 4096  # 缓存多少个编译后的顶点执行计划
+LAYOUT_CACHE_SIZE = 128  # WEB 缓存多少个图的布局
+
+# track 状态变化的合并写入
+BATCH_INTERVAL_MS = 50  # 最多攒多少毫秒写一次
+BATCH_MAX_ROWS = 500  # 最多攒多少行写一次
+BATCH_RETRIES = 5  # 写库失败后重试几次，全部失败这一批修改才丢弃
+BATCH_RETRY_BACKOFF_MS = 100  # 第一次重试前等多少毫秒，之后每次翻倍
+
+BULK_INSERT_ROWS = 5000  # 批量 insert 时每条语句最多多少行
+
+# 脚本输出
+OUTPUT_DIR = '/var/tmp/pipeline/output'  # 每个 track 一个日志文件，每次运行时重新写
+OUTPUT_MAX_BYTES = 64 * 1024 * 1024  # 日志文件最多保留多少字节，超过的部分丢弃，结束时全部压缩存入 blob 表
+OUTPUT_TAIL_BYTES = 64 * 1024  # 运行中查看输出（tail）每次最多返回多少字节
+OUTPUT_CHECK_INTERVAL = 1  # 运行中每隔多少秒检查一次日志文件的大小，超过上限的部分截掉
+
+# 脚本执行方式
+#   line     每一行单独启动一个 shell（原来的方式）
+#   session  整个脚本在一个 shell 中执行，cd、变量在行之间保留
+#   pool     同 session，但使用预先启动的常驻 shell，省掉每个 track 启动进程的开销
+EXEC_MODE = 'session'
+SHELL = '/bin/bash'
+
+# 调度
+WORKERS = 32  # 执行线程数的上限，app.py 可以用 --workers 指定，真正同时运行多少由下边的资源决定
+CPU_CAPACITY = 0  # 本机可以分配的 CPU，0 表示使用 os.cpu_count()
+MEM_CAPACITY_MB = 0  # 本机可以分配的内存，0 表示使用当前可用内存
+DEFAULT_RESOURCES = {'cpu': 1, 'mem_mb': 0}  # 顶点没有声明 resources 时的占用
+PIPELINE_MAX_CONCURRENCY = 0  # 每个 pipeline 最多同时运行多少个 track，0 表示不限制
+GRAPH_MAX_CONCURRENCY = 0  # 使用同一个图的所有 pipeline 最多同时运行多少个 track，0 表示不限制
+GRAPH_MAX_CONCURRENCY_OVERRIDES = {}  # 单独指定某些图的限制 {graph.id: 数量}
+SCHEDULER_RESERVE_AFTER = 30  # 资源不够的 track 在队首等了多少秒之后预留资源，不再让其他 track 插队
+
+# 执行引擎
+#   thread   线程池，每个运行中的脚本占用一个线程
+#   asyncio  asyncio 子进程，一个事件循环线程管理所有运行中的脚本，大量等待型脚本时使用
+ENGINE = 'thread'
+ASYNC_WORKERS = 10000  # asyncio 引擎同时运行的 track 数上限
+ASYNC_DEFAULT_RESOURCES = {'cpu': 0, 'mem_mb': 0}  # asyncio 引擎中没有声明 resources 的 track 按等待型脚本算，不占 CPU
+
+# 关键路径优先：同一个 pipeline 中，到终点的剩余路径（按历史运行时间估计）越长越先运行
+DURATION_ALPHA = 0.3  # 运行时间指数加权平均的系数，越大越看重最近几次
+DURATION_DEFAULT = 1.0  # 没有历史记录的顶点按多少秒估计
+DURATION_HISTORY = 20  # 每个顶点从历史中取最近多少次
+CRITICAL_PATH_REFRESH = 10  # 每个图的剩余路径长度最多多少秒重新计算一次
+
+# 监控指标，Prometheus 文本格式
+METRICS_PORT = 0  # 没有 WEB 的执行器进程单独输出 /metrics 的端口，0 表示不启动，pipeline.worker 可以用 --metrics-port 指定
+
+# SQL 往返统计，按逻辑操作记录查询次数、行数、耗时，调试时打开
+SQL_PROFILE = False
+SQL_PROFILE_REPEAT = 3  # 一次操作中同一条语句执行了这么多次就标记为重复（N+1）
+
+# 运行结果缓存，只对 script 中声明了 "cacheable": true 的顶点生效
+RESULT_CACHE_SIZE = 1024  # 最多缓存多少个结果
+RESULT_CACHE_TTL = 3600  # 结果保留多少秒
+
+# 状态变化推送（SSE）
+EVENTS_QUEUE_SIZE = 1000  # 每个订阅者最多积压多少个事件，超过后丢弃，客户端重新取全量
+EVENTS_KEEPALIVE = 15  # 没有事件时多少秒发一次心跳
+# WEB 和执行器不在同一个进程时，执行器在这个端口转发事件，WEB 连上来接收，0 表示不转发
+# pipeline.worker 可以用 --events-port 指定
+EVENTS_HOST = '127.0.0.1'  # WEB 连接的执行器地址
+EVENTS_PORT = 9109
+EVENTS_RETRY_INTERVAL = 1  # WEB 和执行器的连接断开后多少秒重连
+
+# WEB 历史记录分页
+HISTORY_PAGE_SIZE = 50  # 每页默认多少条
+HISTORY_PAGE_MAX = 500  # 每页最多多少条
+
+# track 输出的压缩存储
+BLOB_CODEC = 'zlib'  # zlib 或者 zstd（需要安装 zstandard，没有安装时使用 zlib）
+BLOB_LEVEL = 6  # 压缩级别
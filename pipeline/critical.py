@@ -0,0 +1,66 @@
+from pipeline.model import db, Track, STATE_SUCCEED
+from pipeline.topology import Topology
+from pipeline import config
+import threading
+import time
+
+
+class DurationEstimator:
+    """ 每个顶点的运行时间估计，用过去的 pipeline 中同一个顶点的运行时间做指数加权平均 """
+
+    def __init__(self, alpha=config.DURATION_ALPHA, default=config.DURATION_DEFAULT):
+        self._alpha = alpha
+        self._default = default
+        self._estimates = {}  # vertex.id -> 秒
+        self._seeded = set()  # 已经从历史记录加载过的 graph.id
+        self._lock = threading.Lock()
+
+    def seed(self, topology: Topology):
+        """ 一个图第一次使用时，从历史记录中加载，和 observe 一样不算使用缓存结果的 track """
+        if topology.graph_id in self._seeded:
+            return
+        rows = db.session.query(Track.vertex_id, Track.started_at, Track.ended_at) \
+            .filter(Track.vertex_id.in_(topology.ids) & (Track.state == STATE_SUCCEED) & (Track.cached == 0) &
+                    Track.ended_at.isnot(None)) \
+            .order_by(Track.id.desc()).limit(len(topology) * config.DURATION_HISTORY).all()
+        with self._lock:
+            for vertex_id, started_at, ended_at in reversed(rows):  # 按时间先后
+                self._observe(vertex_id, (ended_at - started_at).total_seconds())
+            self._seeded.add(topology.graph_id)
+
+    def _observe(self, vertex_id, seconds):
+        old = self._estimates.get(vertex_id)
+        self._estimates[vertex_id] = seconds if old is None else old + self._alpha * (seconds - old)
+
+    def observe(self, vertex_id, seconds):
+        with self._lock:
+            self._observe(vertex_id, seconds)
+
+    def get(self, vertex_id):
+        return self._estimates.get(vertex_id, self._default)
+
+
+class CriticalPath:
+    """
+    每个顶点到终点的最长剩余路径，路径长度是路上各顶点估计运行时间之和
+    按拓扑序倒着算一遍 O(V+E)，结果按图缓存，最多 refresh 秒重新计算一次
+    """
+
+    def __init__(self, estimator: DurationEstimator, refresh=config.CRITICAL_PATH_REFRESH):
+        self.estimator = estimator
+        self._refresh = refresh
+        self._ranks = {}  # graph.id -> (计算时间, 下标 -> 剩余路径长度)
+
+    def _compute(self, topology: Topology):
+        self.estimator.seed(topology)
+        ranks = [0.0] * len(topology)
+        for i in reversed(topology.order):
+            tail = max((ranks[n] for n in topology.successors[i]), default=0.0)
+            ranks[i] = self.estimator.get(topology.ids[i]) + tail
+        return ranks
+
+    def rank(self, topology: Topology, vertex_id):
+        cached = self._ranks.get(topology.graph_id)
+        if cached is None or cached[0] + self._refresh < time.monotonic():
+            cached = self._ranks[topology.graph_id] = (time.monotonic(), self._compute(topology))
+        return cached[1][topology.index[vertex_id]]
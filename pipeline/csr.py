@@ -0,0 +1,78 @@
+import numpy as np
+
+"""
+压缩稀疏行（CSR）表示的图，和向量化的图算法
+顶点是 0..n-1 的下标，顶点 i 的后继是 indices[indptr[i]:indptr[i + 1]]
+多个图可以拼成一个大图一起算，互相之间没有边，结果互不影响
+"""
+
+
+class CSRGraph:
+    def __init__(self, n, tails, heads):
+        # tails, heads  边的起点、终点下标数组
+        tails = np.asarray(tails, dtype=np.int64)
+        heads = np.asarray(heads, dtype=np.int64)
+        self.n = n
+        self.indices = heads[np.argsort(tails, kind='stable')]  # 按起点排序后的终点
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tails, minlength=n), out=self.indptr[1:])
+        self.indegree = np.bincount(heads, minlength=n)
+
+    @classmethod
+    def from_ids(cls, vertex_ids, tails, heads):
+        """ 用数据库中的顶点 id 建图，返回 (图, 排好序的顶点 id)，下标 i 对应 ids[i] """
+        ids = np.unique(np.asarray(vertex_ids, dtype=np.int64))
+        return cls(len(ids), np.searchsorted(ids, tails), np.searchsorted(ids, heads)), ids
+
+    def successors(self, frontier):
+        """ 一组顶点的所有后继，不去重 """
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        total = counts.sum()
+        if not total:
+            return np.empty(0, dtype=np.int64)
+        # 每个顶点的后继在 indices 中是连续的一段，一次算出所有位置
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        return self.indices[offsets]
+
+
+def levels(g: CSRGraph):
+    """
+    kahn 算法按层执行，每层一次向量运算
+    返回每个顶点的层号（到入度为 0 的顶点的最长路径），在环上或者环后边的顶点为 -1
+    """
+    indegree = g.indegree.copy()
+    level = np.full(g.n, -1, dtype=np.int64)
+    frontier = np.flatnonzero(indegree == 0)
+    k = 0
+    while frontier.size:
+        level[frontier] = k
+        nexts = g.successors(frontier)
+        indegree -= np.bincount(nexts, minlength=g.n)
+        candidates = np.unique(nexts)
+        frontier = candidates[indegree[candidates] == 0]
+        k += 1
+    return level
+
+
+def has_cycle(g: CSRGraph):
+    return bool((levels(g) < 0).any())
+
+
+def topological_sort(g: CSRGraph):
+    """ 返回拓扑序的下标数组，有环返回 None """
+    level = levels(g)
+    if (level < 0).any():
+        return None
+    return np.argsort(level, kind='stable')
+
+
+def reachable(g: CSRGraph, sources):
+    """ 从 sources 出发能到达的顶点（包括 sources 自己），返回布尔数组 """
+    seen = np.zeros(g.n, dtype=bool)
+    frontier = np.unique(np.asarray(sources, dtype=np.int64))
+    while frontier.size:
+        seen[frontier] = True
+        nexts = np.unique(g.successors(frontier))
+        frontier = nexts[~seen[nexts]]
+    return seen
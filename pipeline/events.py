@@ -0,0 +1,193 @@
+from pipeline import config
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from collections import defaultdict
+from loguru import logger
+import simplejson
+import threading
+import socket
+import queue
+import time
+
+"""
+状态变化事件，batcher 写库成功后发布，WEB 的 SSE 接口订阅
+只推送变化的部分，没有人订阅的 pipeline 发布时直接返回
+订阅者按 pipeline 分组，发布只遍历这个 pipeline 的订阅者，不会阻塞写库线程
+WEB 单独运行时进程中没有执行器，执行器进程用 start_server 把事件转发出去，
+WEB 进程用一个 EventRelay 连接接收，再发布到本进程的 hub，不管有多少个 SSE 客户端都不查数据库
+"""
+
+
+class Subscription:
+    def __init__(self, hub, pipeline_id, maxsize):
+        self.pipeline_id = pipeline_id
+        self.overflow = False  # 队列满时丢了事件，客户端需要重新取一次全量
+        self._hub = hub
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.overflow = True
+
+    def resync(self):
+        """ 中间可能丢了事件，让订阅者马上重新取一次全量 """
+        self.overflow = True
+        self.put({'type': 'resync'})  # 只是唤醒等待的订阅者，订阅者先检查 overflow
+
+    def get(self, timeout=None):
+        """ 取下一个事件，超时返回 None """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EventHub:
+    def __init__(self, maxsize=config.EVENTS_QUEUE_SIZE):
+        self._maxsize = maxsize
+        self._subscriptions = defaultdict(set)  # pipeline.id -> {Subscription}
+        self._listeners = []  # 接收所有 pipeline 事件的回调，转发给其他进程
+        self._lock = threading.Lock()
+        self.local = False  # 本进程中有没有执行器发布事件
+
+    def attach(self):
+        """ 执行器的 batcher 创建时调用，之后本进程中的状态变化都会发布到这里 """
+        self.local = True
+
+    def listen(self, fn):
+        """ fn(pipeline_id, event) 在发布事件的线程中调用，不能阻塞 """
+        with self._lock:
+            self._listeners = self._listeners + [fn]
+
+    def unlisten(self, fn):
+        with self._lock:
+            self._listeners = [f for f in self._listeners if f is not fn]
+
+    def subscribe(self, pipeline_id):
+        subscription = Subscription(self, pipeline_id, self._maxsize)
+        with self._lock:
+            self._subscriptions[pipeline_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.pipeline_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.pipeline_id]
+
+    def watched(self, pipeline_id):
+        return pipeline_id in self._subscriptions
+
+    def publish(self, pipeline_id, event: dict):
+        for fn in self._listeners:
+            fn(pipeline_id, event)
+        if pipeline_id not in self._subscriptions:  # 没有人看，不用加锁
+            return
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(pipeline_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def resync(self):
+        """ 和执行器的连接断开过，所有订阅者都重新取一次全量 """
+        with self._lock:
+            subscriptions = [s for group in self._subscriptions.values() for s in group]
+        for subscription in subscriptions:
+            subscription.resync()
+
+
+# 全局的事件中心，执行器和 WEB 在同一个进程时 SSE 直接收到推送
+hub = EventHub()
+
+
+class _Handler(StreamRequestHandler):
+    """ 一个 WEB 进程一个连接，一行一个 JSON 事件，空闲时发空行当心跳 """
+
+    def handle(self):
+        events = queue.Queue(config.EVENTS_QUEUE_SIZE)
+        dropped = threading.Event()
+
+        def forward(pipeline_id, event):
+            try:
+                events.put_nowait(dict(event, pipeline=pipeline_id))
+            except queue.Full:  # WEB 读得太慢，断开连接，WEB 重连后重新取全量
+                dropped.set()
+
+        hub.listen(forward)
+        try:
+            while not dropped.is_set():
+                try:
+                    event = events.get(timeout=config.EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    self.wfile.write(b'\n')
+                    continue
+                self.wfile.write(simplejson.dumps(event).encode() + b'\n')
+        except OSError:  # WEB 断开了
+            pass
+        finally:
+            hub.unlisten(forward)
+
+
+def start_server(port, addr='0.0.0.0'):
+    """ 执行器进程调用，把本进程的事件转发给单独运行的 WEB """
+    ThreadingTCPServer.allow_reuse_address = True
+    server = ThreadingTCPServer((addr, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class EventRelay:
+    """
+    WEB 进程中的一个后台线程，连接执行器的 start_server，把收到的事件发布到本进程的 hub
+    连接断开后每 EVENTS_RETRY_INTERVAL 秒重连，重连后所有订阅者重新取一次全量
+    """
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.connected = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                with socket.create_connection(self.address) as sock:
+                    sock.settimeout(config.EVENTS_KEEPALIVE * 2)  # 心跳都收不到，连接已经断了
+                    self.connected = True
+                    hub.resync()
+                    for line in sock.makefile('rb'):
+                        if line.strip():
+                            event = simplejson.loads(line)
+                            hub.publish(event.pop('pipeline'), event)
+            except (OSError, ValueError) as e:
+                if self.connected:
+                    logger.warning(f'事件连接断开 {self.address}: {e!r}')
+            self.connected = False
+            time.sleep(config.EVENTS_RETRY_INTERVAL)
+
+
+_relay = None
+_relay_lock = threading.Lock()
+
+
+def relay():
+    """ 第一次有 SSE 订阅时启动，本进程中有执行器时不需要 """
+    global _relay
+    if hub.local or not config.EVENTS_PORT:
+        return None
+    with _relay_lock:
+        if _relay is None:
+            _relay = EventRelay(config.EVENTS_HOST, config.EVENTS_PORT)
+    return _relay
@@ -1,19 +1,41 @@
 from pipeline.model import Graph, Vertex, Edge, Pipeline, Track, db
+from pipeline import config
 from pipeline.model import STATE_WAITING, STATE_PENDING, STATE_RUNNING, STATE_SUCCEED, STATE_FAILED, STATE_FINISH
-import re
+from pipeline.model import STATE_NAMES, STATE_COUNTERS
+from pipeline import metrics
+from pipeline.profiler import profiled
 from pipeline.service import transactional
+from pipeline.topology import Topology, topologies
+from pipeline.cache import results, result_key
+from pipeline.plan import plans, parse_json, compile_input, coerce, compile_template, render_template
+from pipeline.batcher import StateBatcher
+from pipeline.events import hub
+from pipeline.scheduler import Job, Scheduler
+from pipeline.critical import CriticalPath, DurationEstimator
+from datetime import datetime
 import simplejson
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import asyncio
+from asyncio.subprocess import STDOUT, DEVNULL
 import threading
+import tempfile
 import queue
-from subprocess import Popen
-from tempfile import TemporaryFile
+import time
+from pipeline.output import OutputCapture
+from pipeline.shell import ShellPool, run_lines, run_session, wrap_script, parse_statuses
 from loguru import logger
-from collections import defaultdict
+from collections import defaultdict, Counter
 
+TRACK_WAIT = metrics.histogram('pipeline_track_wait_seconds', 'track 从 PENDING 到 RUNNING 等待的时间')
+TRACK_RUN = metrics.histogram('pipeline_track_run_seconds', 'track 的运行时间', ('state',))
+RESULT_CACHE = metrics.counter('pipeline_result_cache_total', '可以缓存的 track 查找运行结果缓存的次数', ('result',))
+PIPELINES_DONE = metrics.counter('pipeline_pipelines_completed_total', '执行器中结束的 pipeline 数', ('state',))
 
+
+@profiled('start_pipeline')
 @transactional
-def start_pipeline(g_id, name: str, desc: str = None):
+def start_pipeline(g_id, name: str, desc: str = None, priority: int = 0):
     """ 查询入度为零的点 的 SQL """
 
     graph = db.session.query(Graph).get(g_id)
@@ -26,6 +48,7 @@ def start_pipeline(g_id, name: str, desc: str = None):
     p.graph_id = graph.id
     p.state = STATE_RUNNING
     p.desc = desc
+    p.priority = priority
     db.session.add(p)
 
     # 查询这个 graph 中所有顶点
@@ -36,7 +59,9 @@ def start_pipeline(g_id, name: str, desc: str = None):
     # 等价 SQL：子查询的方式
     # SELECT * FROM vertex WHERE graph_id =1 AND vertex.id NOT IN (SELECT edge.head from edge WHERE graph_id =1)
 
+    tracks = 0
     for v in vertexes:
+        tracks += 1
         # 写入 track 表
         t = Track()
 
@@ -49,6 +74,10 @@ def start_pipeline(g_id, name: str, desc: str = None):
         # t.script = v.script
         db.session.add(t)
 
+    p.tracks_total = tracks
+    p.tracks_pending = len(zds)
+    p.tracks_waiting = tracks - len(zds)
+
     # 标记有人使用过了，sealed 封闭
     if graph.sealed == 0:
         graph.sealed = 1
@@ -57,6 +86,44 @@ def start_pipeline(g_id, name: str, desc: str = None):
     return p
 
 
+@profiled('start_pipelines')
+@transactional
+def start_pipelines(g_id, runs: list):
+    """
+    用同一个图批量启动多条 pipeline，runs: [{'name': ..., 'desc': ..., 'priority': 0}, ...]
+    不创建 ORM 对象，Track 用 core 的批量 insert 在一个事务中写入，返回新 pipeline 的 id 列表
+    """
+
+    graph = db.session.query(Graph).get(g_id)
+    if not graph.checked:
+        raise ValueError('这个图不符合 DAG')
+
+    topology = topologies.get(graph.id)  # 入度为 0 的顶点已经算好了，不用再查数据库
+    sources = set(topology.sources)
+
+    # pipeline 要拿到自增 id，MySQL 多行 insert 不能可靠返回每行的 id，只好一行一条，但语句很小
+    ids = []
+    for run in runs:
+        result = db.session.execute(Pipeline.__table__.insert().values(
+            graph_id=graph.id, name=run['name'], desc=run.get('desc'), priority=run.get('priority', 0),
+            state=STATE_RUNNING, tracks_total=len(topology), tracks_pending=len(sources),
+            tracks_waiting=len(topology) - len(sources)))
+        ids.append(result.inserted_primary_key[0])
+
+    rows = [{'pipeline_id': p_id, 'vertex_id': v_id, 'state': STATE_PENDING if i in sources else STATE_WAITING}
+            for p_id in ids for i, v_id in enumerate(topology.ids)]
+    for start in range(0, len(rows), config.BULK_INSERT_ROWS):  # 分块，避免单条语句过大
+        db.session.execute(Track.__table__.insert(), rows[start:start + config.BULK_INSERT_ROWS])
+
+    # 标记有人使用过了，sealed 封闭
+    if graph.sealed == 0:
+        graph.sealed = 1
+        db.session.add(graph)
+
+    return ids
+
+
+@profiled('show_pipeline')
 def show_pipeline(p_id, state=[STATE_PENDING], exclude=[STATE_FAILED]):
     """
     显示流程相关的所有信息：流程信息、顶点状态、顶点里边的 input 和 script
@@ -85,12 +152,18 @@ def show_pipeline(p_id, state=[STATE_PENDING], exclude=[STATE_FAILED]):
     return pipelines.all()
 
 
-TYPES = {
-    'str': str,
-    'string': str,
-    'int': int,
-    'integer': int
-}
+def pipeline_summary(p_id):
+    """ pipeline 的状态和各个状态的 track 数，只读 pipeline 表的计数列，不扫 track 表 """
+    columns = [getattr(Pipeline, name) for name in STATE_COUNTERS.values()]
+    row = db.session.query(Pipeline.id, Pipeline.name, Pipeline.state, Pipeline.tracks_total, *columns) \
+        .filter(Pipeline.id == p_id).one_or_none()
+    db.session.commit()
+    if row is None:
+        return None
+    p_id, name, state, total, *counts = row
+    return {'id': p_id, 'name': name, 'state': state, 'total': total,
+            'tracks': dict(zip(STATE_COUNTERS, counts))}
+
 
 """
 input = {"ip": {"type": "str", "required": True, "default": '192.168.0.100'}}
@@ -98,22 +171,21 @@ input = {"ip": {"type": "str", "required": True, "default": '192.168.0.100'}}
 
 
 def finish_params(t_id, d: dict, inp):
-    """ 把参数值转换为指定的类型"""
+    """ 把参数值转换为指定的类型，执行器使用的是 plans 中编译好的结果 """
 
     # inp  {'ip': {'type': 'str', 'required': True, 'default': '192.168.0.100'}}
     # d    {'ip': '192.168.0.100'}
-
     if inp:
-        params = {}
-        for k, v in inp.items():  # 遍历 inp
-            if k in d.keys():  # 如果 k 在 d 中也有对应，就。。
-                params[k] = TYPES.get(v['type'], str)(d[k])  # 用 inp 中指定的类型参数，去转换 d 中对应的值的类型。
-            elif v.get('default', False):  # 如果 k 没有对应的上，就去转换 default 中的值
-                params[k] = TYPES.get(v['type'], str)(v.get('default'))
-            else:
-                raise TypeError('参数类型错误')
-        # params: {'ip': '192.168.0.100'}
-        return params
+        return coerce(compile_input(inp), d)  # params: {'ip': '192.168.0.100'}
+
+
+def render_script(script: str, params: dict):
+    """ 把参数填充进 script 内 """
+
+    # script: {'script': 'echo "test1.A"\nping {ip}', 'next': 'B'}
+    script = parse_json(script).get('script')
+    # 结果:      echo "test1.A"\nping 192.168.0.100
+    return render_template(compile_template(script if isinstance(script, str) else ''), params)
 
 
 @transactional
@@ -122,30 +194,8 @@ def finish_script(t_id, script: str, params: dict):
     把参数填充进 script 内
     之后把 script 和 input 存 track 库
     """
+    newline = render_script(script, params)
 
-    # script: {'script': 'echo "test1.A"\nping {ip}', 'next': 'B'}
-
-    try:
-        if script:
-            if not isinstance(script, str):
-                raise
-            script = simplejson.loads(script).get('script')
-    except Exception as e:
-        # logger.error(e)
-        script = ''
-
-    newline = ''
-    start = 0
-    pattern = re.compile(r'{([^{}]+)}')
-    for matcher in pattern.finditer(script):  # 把 script 中留的关键字取出来
-        newline += script[start:matcher.start()]  # 拼字
-        tmp = params.get(matcher.group(1), '')  # 用关键字去参数 params 中找出对应的值
-        newline += str(tmp)  # 拼字
-        start = matcher.end()  # 拼字
-    else:
-        newline += script[start:]  # 拼字
-
-    # newline:      echo "test1.A"\nping 192.168.0.100
     track = db.session.query(Track).filter(Track.id == t_id).one()
     track.input = simplejson.dumps(params)
     track.script = newline
@@ -154,111 +204,485 @@ def finish_script(t_id, script: str, params: dict):
     return newline
 
 
-class Executor:
-    def __init__(self):
-        self._executor = ThreadPoolExecutor(max_workers=3)  # 池最大运行 3 个线程
+class PipelineRun:
+    """
+    执行器内存中一个 pipeline 的运行状态
+    remaining 记录每个顶点还有多少前置没有成功，减到 0 就可以 pending 了，不用再去数据库 COUNT
+    states 记录每个 track 的状态，状态是延迟写库的，判断流程是否结束只能看内存中的
+    counts 是各个状态的 track 数，随 set_state 更新，判断是否结束不用遍历 states
+    """
+
+    def __init__(self, pipeline_id, topology: Topology, tracks, state=STATE_RUNNING):
+        # tracks  [(track.id, track.vertex_id, track.state), ...]
+        self.pipeline_id = pipeline_id
+        self.topology = topology
+        self.state = state  # pipeline 的状态，已经失败的 pipeline 中还在运行的 track 结束时会重新加载
+        self.tracks = [None] * len(topology)  # 顶点下标 -> track id
+        self.indexes = {}  # track id -> 顶点下标
+        self.states = [STATE_WAITING] * len(topology)  # 顶点下标 -> track 状态
+        self.remaining = list(topology.indegree)
+
+        for track_id, vertex_id, state in tracks:
+            i = topology.index[vertex_id]
+            self.tracks[i] = track_id
+            self.indexes[track_id] = i
+            self.states[i] = state
+        self.counts = Counter(self.states)
+
+        for track_id, vertex_id, state in tracks:  # 已经成功的 track 要先扣掉
+            if state == STATE_SUCCEED:
+                for n in topology.successors[topology.index[vertex_id]]:
+                    self.remaining[n] -= 1
+
+    @classmethod
+    def load(cls, pipeline_id, graph_id):
+        state = db.session.query(Pipeline.state).filter(Pipeline.id == pipeline_id).scalar()
+        tracks = db.session.query(Track.id, Track.vertex_id, Track.state) \
+            .filter(Track.pipeline_id == pipeline_id).all()
+        return cls(pipeline_id, topologies.get(graph_id), tracks, state)
+
+    def set_state(self, track_id, state):
+        i = self.indexes[track_id]
+        self.counts[self.states[i]] -= 1
+        self.counts[state] += 1
+        self.states[i] = state
+
+    def count(self, state):
+        return self.counts[state]
+
+    def succeed(self, track_id):
+        """ track 成功，后继的前置计数减一，返回前置全部做完的 track id """
+        pendings = []
+        for n in self.topology.successors[self.indexes[track_id]]:
+            self.remaining[n] -= 1
+            if self.remaining[n] == 0:
+                pendings.append(self.tracks[n])
+        return pendings
+
+
+class BaseExecutor:
+    """
+    调度、完成处理和状态保存，两种执行引擎共用，track 的状态变化完全一样
+    子类只负责怎么运行脚本：_start 返回一个 concurrent.futures.Future，结果是 (code_state, texts)
+    default_resources 是没有声明 resources 的 track 在调度器中的占用，不同的引擎不一样
+    """
+
+    default_resources = config.DEFAULT_RESOURCES
+
+    def __init__(self, workers):
+        self._scheduler = Scheduler(workers)  # 控制同时运行的数量和 pipeline 之间的顺序
         self._tasks = {}
+        self._lock = threading.Lock()  # 保护 _tasks，提交和回调在不同线程中
         self._event = threading.Event()
         self._queue = queue.Queue()
         self._states = defaultdict(dict)
-        threading.Thread(target=self._run).start()
+        self._ready = queue.Queue()  # 就绪队列，变为 PENDING 的 track 直接放入这里
+        self._in_flight = set()  # 已经提交、结果还没有保存的 track，同一个 track 同时只提交一次，resume 时不动它们
+        self._runs = {}  # pipeline.id -> PipelineRun，只在保存线程中使用
+        self._batcher = StateBatcher()  # 状态变化合并后批量写库
+        self._critical = CriticalPath(DurationEstimator())  # 按历史运行时间估计关键路径
+        self._pending_since = {}  # track id -> 放入就绪队列的时间，用来统计等待时间
+        metrics.gauge('pipeline_completion_queue_depth', '等待保存结果的 track 数', fn=self._queue.qsize)
+        metrics.gauge('pipeline_ready_queue_depth', '等待准备脚本的 track 数', fn=self._ready.qsize)
+        metrics.gauge('pipeline_scheduler_queue_depth', '等待调度器分配名额的 track 数', fn=lambda: len(self._scheduler))
+        metrics.gauge('pipeline_tracks_in_flight', '正在运行的 track 数', fn=lambda: len(self._tasks))
+        metrics.gauge('pipeline_pipelines_active', '执行器中正在运行的 pipeline 数', fn=lambda: len(self._runs))
         threading.Thread(target=self._save_track).start()
+        threading.Thread(target=self._dispatch).start()
+        threading.Thread(target=self._submit).start()
+
+    @property
+    def batcher(self):
+        return self._batcher
+
+    @staticmethod
+    def _summarize(track_id, code, statuses, capture: OutputCapture):
+        code_state = code
+        for no, c in statuses:
+            code_state = code_state | c  # 总状态码，有一次运行失败即为失败
+            if c != 0:
+                logger.info(f'track {track_id} 第 {no} 行退出码 {c}')
+
+        return code_state, capture.text()  # 日志文件的全部内容（最多 OUTPUT_MAX_BYTES），压缩存入 blob 表
+
+    def _start(self, job: Job):
+        raise NotImplementedError
+
+    def _stop(self, wait):
+        raise NotImplementedError
+
+    def dispatch(self, track_id):
+        """把 PENDING 的 track 放入就绪队列，由调度线程提交"""
+        if track_id not in self._in_flight:  # 重复放入的不算
+            self._pending_since.setdefault(track_id, time.monotonic())
+        self._ready.put(track_id)
+
+    def load_pipeline(self, p_id):
+        """把一个 pipeline 中所有 PENDING 的 track 放入就绪队列，start_pipeline 之后调用一次即可"""
+        self.load_pipelines([p_id])
+
+    @profiled('load_pipelines')
+    def load_pipelines(self, p_ids):
+        """批量版本，start_pipelines 之后调用，一次查询"""
+        query = db.session.query(Track.id).filter(Track.pipeline_id.in_(p_ids) & (Track.state == STATE_PENDING))
+        for track_id, in query:
+            self.dispatch(track_id)
+        db.session.commit()
+
+    @profiled('resume_pipeline')
+    def resume_pipeline(self, p_id):
+        """
+        继续执行一个失败或者中断的 pipeline，只重跑失败的 track 和它们的所有下游，成功的 track 和输出保留
+        状态是 RUNNING 但不在本执行器中运行的 track（比如进程重启前在运行的）也按失败处理
+        返回重新放入就绪队列的 track id
+        """
+        self._batcher.flush()  # 先把还没写的状态写进去，再从数据库加载
+        try:
+            pipeline = db.session.query(Pipeline.graph_id, Pipeline.state).filter(Pipeline.id == p_id).one_or_none()
+            if pipeline is None:
+                raise ValueError(f'pipeline {p_id} 不存在')
+            graph_id, p_state = pipeline
+            if p_state == STATE_FINISH:
+                raise ValueError(f'pipeline {p_id} 已经完成')
+
+            topology = topologies.get(graph_id)
+            tracks = db.session.query(Track.id, Track.vertex_id, Track.state) \
+                .filter(Track.pipeline_id == p_id).all()
+            ids = [None] * len(topology)  # 顶点下标 -> track id
+            states = [STATE_WAITING] * len(topology)
+            for track_id, vertex_id, state in tracks:
+                i = topology.index[vertex_id]
+                ids[i], states[i] = track_id, state
+
+            # 已经交给本执行器、还没有结束的 track 会自己完成，不动它们
+            live = {i for i, t_id in enumerate(ids)
+                    if t_id in self._in_flight and states[i] in (STATE_PENDING, STATE_RUNNING)}
+
+            # 失败的 track 和它们的所有下游都要重跑
+            frontier = [i for i, state in enumerate(states)
+                        if (state == STATE_FAILED or state == STATE_RUNNING) and i not in live]
+            reset = set(frontier)
+            while frontier:
+                frontier = [n for i in frontier for n in topology.successors[i] if n not in reset]
+                reset.update(frontier)
+            reset -= live
+
+            kept = {i for i, state in enumerate(states) if state == STATE_SUCCEED and i not in reset}
+            changes = {STATE_PENDING: [], STATE_WAITING: []}
+            pendings = []
+            for i, t_id in enumerate(ids):
+                if i in kept or i in live or t_id is None:
+                    continue
+                # 前置全部成功的直接 pending，其余的等前置做完
+                state = STATE_PENDING if all(p in kept for p in topology.predecessors[i]) else STATE_WAITING
+                if i in reset or states[i] != state:
+                    changes[state].append(t_id)
+                states[i] = state
+                if state == STATE_PENDING:
+                    pendings.append(t_id)
+
+            for state, t_ids in changes.items():
+                if t_ids:
+                    db.session.query(Track).filter(Track.id.in_(t_ids)).update(
+                        {Track.state: state, Track.output_digest: None, Track.started_at: None, Track.ended_at: None,
+                         Track.cached: 0}, synchronize_session=False)
+            # 计数列按重置后的状态重新算一遍，之前有偏差的也一起修正
+            counts = Counter(state for i, state in enumerate(states) if ids[i] is not None)
+            values = {getattr(Pipeline, column): counts[state] for state, column in STATE_COUNTERS.items()}
+            values[Pipeline.tracks_total] = sum(counts.values())
+            values[Pipeline.state] = STATE_RUNNING
+            db.session.query(Pipeline).filter(Pipeline.id == p_id).update(values, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        self._runs.pop(p_id, None)  # 内存中的运行状态已经过时，下次使用时重新加载
+        hub.publish(p_id, {'type': 'pipeline', 'id': p_id, 'state': STATE_NAMES[STATE_RUNNING]})
+        for state, t_ids in changes.items():
+            for t_id in t_ids:
+                hub.publish(p_id, {'type': 'track', 'id': t_id, 'state': STATE_NAMES[state]})
+        for t_id in pendings:
+            self.dispatch(t_id)
+        logger.info(f'pipeline {p_id} 继续执行，重跑 {len(reset)} 个 track，保留 {len(kept)} 个成功的')
+        return pendings
+
+    @profiled('prepare_track')
+    def _prepare(self, track_id):
+        """填充参数、生成脚本，返回 Job 和 pipeline 的优先级"""
+        pipeline_id, graph_id, priority, vertex_id = db.session.query(
+            Pipeline.id, Pipeline.graph_id, Pipeline.priority, Track.vertex_id) \
+            .join(Pipeline, Pipeline.id == Track.pipeline_id) \
+            .filter(Track.id == track_id).one()
+        rank = self._critical.rank(topologies.get(graph_id), vertex_id)  # 到终点的剩余路径长度
+        plan = plans.get(vertex_id)  # 编译好的参数和脚本模板，同一个顶点只解析一次
+        db.session.commit()  # 只读，结束事务，把连接还给池
+
+        params = plan.params()
+        job = Job(track_id, pipeline_id, graph_id, vertex_id, params, plan.render(params), plan.resources, rank,
+                  self.default_resources)
+        if plan.cacheable:
+            job.result_key = result_key(job.script, params, plan.cache_key)
+        return job, priority
+
+    def _dispatch(self):
+        """单独一个线程，从就绪队列中取 track，准备好后交给调度器，运行中的 track 不会再次提交"""
+        while not self._event.is_set():
+            track_id = self._ready.get()  # 阻塞在这等
+            if track_id is None:  # shutdown 放入的结束标记
+                break
+            if track_id in self._in_flight:
+                continue
+            self._in_flight.add(track_id)
+            try:
+                job, priority = self._prepare(track_id)
+                if job.result_key and self._cached(job):  # 命中缓存的不用进调度器
+                    continue
+                self._scheduler.push(job, priority)
+            except Exception as e:
+                logger.error(e)
+                db.session.rollback()
+                self._fail(track_id, e)
 
-    def _script_executor(self, track_id, script):
-        code_state = 0
-        with TemporaryFile('a+') as tf:  # 打开临时文件
-            for line in script.splitlines():  # 按行分割
-                p = Popen(line, shell=True, stdout=tf, stderr=tf)
-                code = p.wait()  # 阻塞等，code 为 0 是正确执行
-                code_state = code_state | code  # 总状态码，有一次运行失败即为失败
-            tf.flush()  # flush 文件到磁盘
-            tf.seek(0)  # 游标回到开头
-            texts = tf.read()  # 读取执行结果
-
-        return code_state, texts
-
-    def executor(self, track_id):
-        """异步执行方法，只负责提交任务，任务运行结束，会返回运行结果"""
+    def _fail(self, track_id, error):
+        """准备脚本出错的 track（比如参数类型不对），和运行失败一样走完成队列，track 和 pipeline 都改为失败"""
         try:
-            # 修改 track 状态为 RUNNING
-            track = db.session.query(Track).get(track_id)
-            track.state = STATE_RUNNING
-            db.session.add(track)
+            pipeline_id, graph_id, vertex_id = db.session.query(Track.pipeline_id, Pipeline.graph_id, Track.vertex_id) \
+                .join(Pipeline, Pipeline.id == Track.pipeline_id) \
+                .filter(Track.id == track_id).one()
             db.session.commit()
-            self._tasks[self._executor.submit(self._script_executor, track.id, track.script)] = track.id  # 异步提交任务
-        except Exception as e:
+        except Exception as e:  # 连数据库都查不了，保持 PENDING，resume_pipeline 时可以再次提交
             logger.error(e)
             db.session.rollback()
-
-    def _run(self):
-        """单独一个线程，等待任务的返回值"""
-        while not self._event.wait(3):
-            for future in as_completed(self._tasks):  # 阻塞在这等返回值
-                track_id = self._tasks[future]
-                try:
-                    code_state, texts = future.result()
-                    self._queue.put((track_id, code_state, texts))
-                except Exception as e:
-                    logger.error(e)
-                finally:
-                    del self._tasks[future]  # 任务运行完要从任务列表中删除
+            self._pending_since.pop(track_id, None)
+            self._in_flight.discard(track_id)
+            return
+        job = Job(track_id, pipeline_id, graph_id, vertex_id, {}, '')
+        self._running(job)
+        self._queue.put((job, 1, str(error)))
+
+    def _submit(self):
+        """单独一个线程，按调度器给出的顺序提交，有空闲名额时才会取到"""
+        while True:
+            job = self._scheduler.pop()  # 阻塞在这等
+            if job is None:  # shutdown
+                break
+            self.executor(job)
+
+    def _cached(self, job: Job):
+        """查找运行结果缓存，命中时不启动进程，直接把结果放入完成队列"""
+        hit = results.get(job.result_key)
+        RESULT_CACHE.inc(result='hit' if hit else 'miss')
+        if hit is None:
+            return False
+        code_state, texts = hit
+        job.cached = True
+        self._running(job)
+        with OutputCapture(job.track_id) as capture:  # 日志文件中也留一份，tail 可以看到
+            capture.write(texts.encode())
+            capture.collect()
+        logger.info(f'track {job.track_id} 使用缓存的运行结果')
+        self._queue.put((job, code_state, texts))
+        return True
+
+    def _running(self, job: Job):
+        """修改 track 状态为 RUNNING，连同填充好的参数和脚本一起交给 batcher 写库"""
+        job.started_at = datetime.now()
+        pending_since = self._pending_since.pop(job.track_id, None)
+        if pending_since is not None:
+            TRACK_WAIT.observe(time.monotonic() - pending_since)
+        self._batcher.update_track(job.track_id, job.pipeline_id, state=STATE_RUNNING, input=simplejson.dumps(job.params),
+                                   script=job.script, started_at=job.started_at, cached=int(job.cached))
+        self._move(job.pipeline_id, STATE_PENDING, STATE_RUNNING)
+
+    def _move(self, pipeline_id, old, new, n=1):
+        """n 个 track 从 old 状态变为 new，增量更新 pipeline 的计数列"""
+        if n:
+            self._batcher.count_pipeline(pipeline_id, **{STATE_COUNTERS[old]: -n, STATE_COUNTERS[new]: n})
+
+    def executor(self, job: Job):
+        """异步执行方法，只负责提交任务，任务运行结束，会返回运行结果"""
+        self._running(job)
+        with self._lock:
+            future = self._start(job)  # 异步提交任务
+            self._tasks[future] = job
+        future.add_done_callback(self._done)  # 任务结束时回调，不再轮询
+
+    def _done(self, future):
+        """任务的完成回调，在工作线程中调用，任务一结束就把结果放入队列"""
+        with self._lock:
+            job = self._tasks.pop(future)  # 任务运行完要从任务列表中删除
+        self._scheduler.release(job)
+        try:
+            code_state, texts = future.result()
+        except Exception as e:
+            logger.error(e)
+            code_state, texts = 1, str(e)  # 执行器自身出错，也算这个 track 失败
+        self._queue.put((job, code_state, texts))
+
+    def shutdown(self, wait=True):
+        """停止调度和保存线程，等待已提交的任务结束"""
+        self._event.set()
+        self._ready.put(None)  # 唤醒阻塞在队列上的线程
+        self._scheduler.close()
+        self._stop(wait)
+        self._queue.put(None)
+
+    def _run_of(self, pipeline_id, graph_id):
+        """取 pipeline 的运行状态，第一次使用时从数据库加载"""
+        run = self._runs.get(pipeline_id)
+        if run is None:
+            self._batcher.flush()  # 先把还没写的状态写进去，再从数据库加载
+            run = self._runs[pipeline_id] = PipelineRun.load(pipeline_id, graph_id)
+            db.session.commit()
+        return run
 
     def _save_track(self):
-        while not self._event.wait(3):
-            track_id, code_state, texts = self._queue.get()  # 阻塞在这等
-            track = db.session.query(Track).get(track_id)
-            track.output = texts
-            track.state = STATE_SUCCEED if code_state == 0 else STATE_FAILED  # 判断 track 运行状态
-
-            if code_state != 0:  # 如果失败，必须立即将任务流状态设置也为失败
-                logger.info(f'=============== {track.vertex_id} 运行失败')
-                track.pipeline.state = STATE_FAILED
-            else:
-                logger.info(f'=============== {track.vertex_id} 运行成功')
-                others = db.session.query(Track).filter(
-                    (Track.pipeline_id == track.pipeline_id) & (Track.id != track.id)).all()
-
-                states = {STATE_WAITING: 0, STATE_PENDING: 0, STATE_RUNNING: 0, STATE_SUCCEED: 0, STATE_FAILED: 0}
-
-                for t in others:
-                    states[t.state] += 1
-
-                if states[STATE_FAILED] > 0:  # 任务流中有错误
-                    logger.info('任务流中有错误')
-                    track.pipeline.state = STATE_FAILED
-                elif len(others) == states[STATE_SUCCEED]:  # 自己是最后终点，其他全部成功
-                    logger.info(f'{track.vertex_id} 是最后终点')
-                    track.pipeline.state = STATE_FINISH
-                else:
-                    edges = db.session.query(Edge).filter(Edge.graph_id == track.pipeline.graph_id).all()
-                    tailTOhead = defaultdict(list)
-                    headTOtail = defaultdict(list)
-                    for edge in edges:
-                        tailTOhead[edge.tail].append(edge.head)
-                        headTOtail[edge.head].append(edge.tail)
-
-                    if track.vertex_id in tailTOhead.keys():  # 如果在，说明后边还有其他弧尾
-                        logger.info(f'还有其他节点{tailTOhead[track.vertex_id]}')
-                        nexts = tailTOhead[track.vertex_id]  # 以弧头，找弧尾集合
-                        for n in nexts:
-                            tails = headTOtail[n]  # 用弧尾，找到对应的弧头集合。
-                            query = db.session.query(Track).filter(  # 查对应弧头们的执行状态
-                                (Track.pipeline_id == track.pipeline_id) & (Track.vertex_id.in_(tails)) & (
-                                        Track.state == STATE_SUCCEED)).count()
-                            if query == len(tails):  # 如果都成功了，那么这个弧尾就可以 pending 了,前置全部做完
-                                nx = db.session.query(Track).filter(Track.vertex_id == n).one()
-                                nx.state = STATE_PENDING
-                                db.session.add(nx)
-                                logger.info(f'{n} 的前置全部做完，改为 pending')
-                            else:  # 还有前置没有做完
-                                self.info = logger.info(f'{n} 还有前置还未全部执行')
-                                pass  # 什么都不做
+        while True:
+            item = self._queue.get()  # 阻塞在这等，任务一完成立即被唤醒
+            if item is None:  # shutdown 放入的结束标记
+                self._batcher.flush()
+                break
+            job, code_state, texts = item
+            self._in_flight.discard(job.track_id)  # 结果已经拿到，保存出错也不再算运行中，resume 时可以重跑
             try:
-                db.session.commit()
+                pendings = self._complete(job, code_state, texts)
             except Exception as e:
                 logger.error(e)
                 db.session.rollback()
+                self._runs.pop(job.pipeline_id, None)  # 内存中的计数已经不可信，下次重新加载
+                continue
+            for t_id in pendings:
+                self.dispatch(t_id)
+
+    @profiled('save_track')
+    def _complete(self, job: Job, code_state, texts):
+        """
+        一个 track 运行结束，修改状态并找出可以 pending 的后继
+        状态只改内存并交给 batcher，不在这里等数据库
+        """
+        track_id, pipeline_id, vertex_id = job.track_id, job.pipeline_id, job.vertex_id
+        run = self._run_of(pipeline_id, job.graph_id)
+        ended = run.state != STATE_RUNNING  # pipeline 之前已经结束了，这是结束时还在运行的 track
+        state = STATE_SUCCEED if code_state == 0 else STATE_FAILED  # 判断 track 运行状态
+        run.set_state(track_id, state)
+        ended_at = datetime.now()
+        self._batcher.update_track(track_id, pipeline_id, state=state, output=texts, ended_at=ended_at)
+        self._move(pipeline_id, STATE_RUNNING, state)
+        if not job.cached:  # 使用缓存结果的没有真正运行
+            elapsed = (ended_at - job.started_at).total_seconds()
+            TRACK_RUN.observe(elapsed, state=STATE_NAMES[state])
+            if code_state == 0:  # 失败的运行时间没有参考价值
+                self._critical.estimator.observe(vertex_id, elapsed)
+                if job.result_key:  # 只缓存成功的结果
+                    results.put(job.result_key, code_state, texts)
+        pendings = []
+
+        if code_state != 0:  # 如果失败，必须立即将任务流状态设置也为失败
+            logger.info(f'=============== {vertex_id} 运行失败')
+            run.state = STATE_FAILED
+        else:
+            logger.info(f'=============== {vertex_id} 运行成功')
+            if run.count(STATE_FAILED) > 0:  # 任务流中有错误
+                logger.info('任务流中有错误')
+                run.state = STATE_FAILED
+            elif run.count(STATE_SUCCEED) == len(run.states):  # 自己是最后终点，其他全部成功
+                logger.info(f'{vertex_id} 是最后终点')
+                run.state = STATE_FINISH
+            else:
+                pendings = run.succeed(track_id)
+                for t_id in pendings:  # 前置全部做完的，改为 pending
+                    run.set_state(t_id, STATE_PENDING)
+                    self._batcher.update_track(t_id, pipeline_id, state=STATE_PENDING)
+                self._move(pipeline_id, STATE_WAITING, STATE_PENDING, len(pendings))
+                if pendings:
+                    logger.info(f'{pendings} 的前置全部做完，改为 pending')
+
+        if run.state != STATE_RUNNING:  # pipeline 结束了，内存中的运行状态不再需要
+            self._runs.pop(pipeline_id, None)
+            if not ended:  # 只在 RUNNING 变为结束时写一次、计一次
+                self._batcher.update_pipeline(pipeline_id, state=run.state)
+                PIPELINES_DONE.inc(state=STATE_NAMES[run.state])
+        return pendings
+
+
+class Executor(BaseExecutor):
+    """ 线程池执行，每个运行中的脚本占用一个线程 """
+
+    def __init__(self, workers=config.WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._shells = ShellPool(workers) if config.EXEC_MODE == 'pool' else None  # 预先启动的常驻 shell
+        super().__init__(workers)
+
+    def _script_executor(self, track_id, script):
+        with OutputCapture(track_id) as capture:  # 输出边产生边写入 track 的日志文件
+            if self._shells:
+                code, statuses = self._shells.run(script, capture)
+            elif config.EXEC_MODE == 'session':
+                code, statuses = run_session(script, capture)
+            else:
+                code, statuses = run_lines(script, capture)
+        return self._summarize(track_id, code, statuses, capture)
+
+    def _start(self, job: Job):
+        return self._executor.submit(self._script_executor, job.track_id, job.script)
+
+    def _stop(self, wait):
+        self._executor.shutdown(wait=wait)  # 等待中的回调都在工作线程中执行完
+        if self._shells:
+            self._shells.close()
+
+
+class AsyncExecutor(BaseExecutor):
+    """
+    asyncio 执行，所有脚本都是一个事件循环线程中的异步子进程，运行中的脚本不占线程
+    适合大量长时间运行但大部分时间在等待的脚本，比如 ping、sleep
+    脚本总是在一个 shell 中执行（同 EXEC_MODE = 'session'）
+    结果通过回调放入完成队列，状态由保存线程交给 batcher 写库，事件循环不会等数据库
+    运行中的脚本大部分时间在等待，没有声明 resources 的 track 不占 CPU，并发数只受 ASYNC_WORKERS 限制
+    声明了 resources 的仍然按本机的 CPU、内存分配
+    """
+
+    default_resources = config.ASYNC_DEFAULT_RESOURCES
+
+    def __init__(self, workers=config.ASYNC_WORKERS):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        super().__init__(workers)
+
+    async def _script_executor(self, track_id, script):
+        with OutputCapture(track_id) as capture, tempfile.TemporaryFile() as status:
+            # 输出直接写入 track 的日志文件，每行的退出码写到临时文件，同 run_session
+            # 不读管道，脚本中放到后台的进程不会让 track 一直等到它结束
+            fd = status.fileno()
+            proc = await asyncio.create_subprocess_shell(
+                wrap_script(script, fd), executable=config.SHELL,
+                stdin=DEVNULL, stdout=capture, stderr=STDOUT, pass_fds=(fd,))
+            code = await proc.wait()
+            status.seek(0)
+            statuses = parse_statuses(status.read().decode())
+            capture.collect()
+        return self._summarize(track_id, code, statuses, capture)
+
+    def _start(self, job: Job):
+        return asyncio.run_coroutine_threadsafe(self._script_executor(job.track_id, job.script), self._loop)
+
+    def _stop(self, wait):
+        if wait:
+            with self._lock:
+                futures = list(self._tasks)
+            concurrent.futures.wait(futures)
+            # 完成回调在事件循环线程中执行，再走一轮循环，保证回调都执行完了
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def create_executor(engine=config.ENGINE):
+    """ 按配置选择执行引擎 """
+    if engine == 'asyncio':
+        return AsyncExecutor()
+    return Executor()
 
 
 # 全局的任务执行器对象
-executor = Executor()
+executor = create_executor()
@@ -0,0 +1,180 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+"""
+计数器、仪表、直方图，按 Prometheus 文本格式输出
+记录时只是在锁内做一次加法，热路径上的开销可以忽略
+WEB 项目在 /metrics 输出，没有 WEB 的执行器进程用 start_http_server 单独输出
+"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for k, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # 标签值的元组 -> 值
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[k] for k in self.labels)
+
+    def samples(self):
+        """ [(名称后缀, 标签名, 标签值, 值), ...] """
+        with self._lock:
+            return [('', self.labels, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, names, values, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_labels(names, values)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    """ fn 不为空时，每次输出时调用 fn 取值，fn 返回数值或者 {标签值的元组: 值} """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self._fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def dec(self, n=1, **labels):
+        self.inc(-n, **labels)
+
+    def samples(self):
+        if self._fn is None:
+            return super().samples()
+        value = self._fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [('', self.labels, key, v) for key, v in value.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]  # 各个桶、总数、总和
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        names = self.labels + ('le',)
+        for key, counts in items:
+            total = 0
+            for bound, n in zip(self.buckets, counts):
+                total += n  # 输出的桶是累计的
+                samples.append(('_bucket', names, key + (bound,), total))
+            samples.append(('_bucket', names, key + ('+Inf',), counts[-2]))
+            samples.append(('_count', self.labels, key, counts[-2]))
+            samples.append(('_sum', self.labels, key, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        """ 同名的指标只注册一次，返回已经注册的那个 """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+# 全局的指标注册表
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), fn=None):
+    if fn is not None:  # 回调取值的仪表以最后一次注册的为准
+        REGISTRY.unregister(name)
+    return REGISTRY.register(Gauge(name, help, labels, fn))
+
+
+def histogram(name, help, labels=(), buckets=Histogram.BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # 不输出访问日志
+        pass
+
+
+def start_http_server(port, addr='0.0.0.0'):
+    """ 单独的 /metrics 服务，给没有 WEB 的执行器进程使用 """
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,142 @@
+from pipeline import config
+import threading
+import time
+import os
+
+TRUNCATED = b'\n...... output truncated ......\n'
+
+
+def log_path(track_id):
+    return os.path.join(config.OUTPUT_DIR, f'{track_id}.log')
+
+
+def _utf8_boundary(data: bytes):
+    """ 返回 data 中完整 utf-8 字符的长度，避免把一个汉字从中间截断 """
+    for i in range(1, min(4, len(data)) + 1):
+        b = data[-i]
+        if b & 0xC0 == 0x80:  # 后续字节，继续往前找首字节
+            continue
+        if b & 0x80 == 0:  # ASCII
+            return len(data)
+        need = 2 if b & 0xE0 == 0xC0 else 3 if b & 0xF0 == 0xE0 else 4
+        return len(data) if i >= need else len(data) - i
+    return len(data)
+
+
+class _Watcher:
+    """
+    一个线程定时检查所有运行中的日志文件，超过上限的部分截掉
+    脚本直接写文件，没法在写的时候拦住，只能事后截，磁盘占用最多超出一个检查间隔内产生的输出
+    """
+
+    def __init__(self, interval=config.OUTPUT_CHECK_INTERVAL):
+        self._interval = interval
+        self._captures = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, capture):
+        with self._lock:
+            self._captures.add(capture)
+            if self._thread is None:  # 第一次使用时再启动
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def discard(self, capture):
+        with self._lock:  # 检查中的不会被关闭
+            self._captures.discard(capture)
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                for capture in self._captures:
+                    try:
+                        capture.enforce()
+                    except OSError:  # 一个文件出错不能让线程退出
+                        continue
+
+
+_watcher = _Watcher()
+
+
+class OutputCapture:
+    """
+    保存脚本输出到 track 的日志文件，运行中就可以 tail
+    脚本通过 fileno() 直接写日志文件，不经过管道，脚本中放到后台的进程不会让 track 一直等
+    运行中每 OUTPUT_CHECK_INTERVAL 秒检查一次大小，超过 max_bytes 的部分截掉，结束后 collect() 再截一次并加上截断标记
+    结束后日志文件的全部内容（最多 max_bytes）就是 track 的输出，压缩存入 blob 表
+    日志文件每次运行时清空，只有这次运行的输出，不会读到重跑之前或者重建数据库之前同一个 track id 的内容
+    """
+
+    def __init__(self, track_id, max_bytes=config.OUTPUT_MAX_BYTES):
+        os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+        self.path = log_path(track_id)
+        self.truncated = False
+        self._max_bytes = max_bytes
+        self._file = open(self.path, 'ab')  # 追加模式，和直接写文件的子进程交替写也不会互相覆盖
+        self._file.truncate(0)
+        _watcher.add(self)
+
+    def write(self, chunk: bytes):
+        """ 不是由子进程产生的输出（比如缓存的运行结果），写完调用 collect() """
+        self._file.write(chunk)
+
+    def fileno(self):
+        """ 作为子进程的 stdout，子进程直接写文件 """
+        self._file.flush()
+        return self._file.fileno()
+
+    def enforce(self):
+        """ 运行中超过上限时截掉多出的部分，子进程之后写的内容接在上限之后，下次检查再截 """
+        fd = self._file.fileno()
+        if os.fstat(fd).st_size > self._max_bytes:
+            os.ftruncate(fd, self._max_bytes)
+            self.truncated = True
+
+    def collect(self):
+        """ 子进程结束后调用，截到上限 """
+        self._file.flush()
+        end = os.fstat(self._file.fileno()).st_size
+        if end > self._max_bytes or self.truncated:
+            end = min(end, self._max_bytes)
+            os.ftruncate(self._file.fileno(), end)
+            self._file.write(TRUNCATED)
+            self._file.flush()
+            self.truncated = True
+
+    def close(self):
+        _watcher.discard(self)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def text(self):
+        """ 存入 blob 表的输出，日志文件的全部内容，超过上限时以截断标记结尾 """
+        with open(self.path, 'rb') as f:
+            return f.read().decode('utf-8', errors='replace')
+
+
+def tail(track_id, offset=0, limit=config.OUTPUT_TAIL_BYTES):
+    """
+    从 offset 开始读 track 的日志，最多 limit 字节
+    返回 {'offset': 下次读取的位置, 'data': 内容}，offset 为负数表示从末尾往前读
+    """
+    path = log_path(track_id)
+    if not os.path.exists(path):
+        return {'offset': 0, 'data': ''}
+
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset < 0:
+            offset = max(size + offset, 0)
+        offset = min(offset, size)
+        f.seek(offset)
+        data = f.read(limit)
+
+    data = data[:_utf8_boundary(data)]
+    return {'offset': offset + len(data), 'data': data.decode('utf-8', errors='replace')}
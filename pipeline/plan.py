@@ -0,0 +1,105 @@
+from pipeline.model import db, Vertex
+from pipeline.topology import TopologyCache
+from pipeline import config
+import simplejson
+import re
+
+"""
+顶点的执行计划，每个顶点编译一次，反复使用
+input 编译成每个参数的类型转换函数和默认值，script 预先切成字面量和占位符交替的片段
+生成脚本时只需要填入参数值再 join，不用每个 track 都解析 JSON、跑正则
+"""
+
+TYPES = {
+    'str': str,
+    'string': str,
+    'int': int,
+    'integer': int
+}
+
+PLACEHOLDER = re.compile(r'{([^{}]+)}')
+MISSING = object()
+
+
+def parse_json(text):
+    """ input、script 字段的 JSON，不是对象时返回 {} """
+    try:
+        value = simplejson.loads(text) if text and isinstance(text, str) else None
+    except Exception:
+        value = None
+    return value if isinstance(value, dict) else {}
+
+
+def compile_input(inp: dict):
+    """ input 定义编译成 ((参数名, 类型转换函数, 默认值), ...)，没有默认值的为 MISSING """
+    fields = []
+    for k, v in inp.items():
+        default = v.get('default', False)
+        fields.append((k, TYPES.get(v['type'], str), v.get('default') if default else MISSING))
+    return tuple(fields)
+
+
+def coerce(fields, values: dict):
+    """ 把参数值转换为 input 指定的类型，values 中没有的用默认值 """
+    params = {}
+    for k, convert, default in fields:
+        if k in values:
+            params[k] = convert(values[k])
+        elif default is not MISSING:
+            params[k] = convert(default)
+        else:
+            raise TypeError('参数类型错误')
+    return params
+
+
+def compile_template(script: str):
+    """ 切成 [字面量, 占位符, 字面量, 占位符, ..., 字面量]，奇数位置是参数名 """
+    return tuple(PLACEHOLDER.split(script or ''))
+
+
+def render_template(segments, params: dict):
+    parts = list(segments)
+    parts[1::2] = [str(params.get(name, '')) for name in segments[1::2]]
+    return ''.join(parts)
+
+
+class VertexPlan:
+    """ 一个顶点编译后的执行计划 """
+
+    def __init__(self, vertex_id, input, script):
+        # input、script  Vertex 表中的原始 JSON 文本
+        self.vertex_id = vertex_id
+        self.options = parse_json(script)  # script 字段的其他配置，resources 等
+        script = self.options.get('script')
+        self.segments = compile_template(script if isinstance(script, str) else '')
+        resources = self.options.get('resources')
+        self.resources = resources if isinstance(resources, dict) else None
+        self.cacheable = bool(self.options.get('cacheable'))  # 相同的脚本和参数直接使用上次的结果
+        self.cache_key = self.options.get('cache_key')  # 脚本以外影响结果的东西，比如数据的版本
+
+        # 参数目前只取 default，所以每个顶点的参数值是固定的，编译时直接算好
+        inp = parse_json(input)
+        self._error = None
+        try:
+            self._params = coerce(compile_input(inp), {k: v.get('default', '127.0.0.1') for k, v in inp.items()})
+        except Exception as e:  # 定义有问题的顶点，等到使用时再报错
+            self._params, self._error = {}, e
+
+    @classmethod
+    def load(cls, vertex_id):
+        vertex_input, vertex_script = db.session.query(Vertex.input, Vertex.script) \
+            .filter(Vertex.id == vertex_id).one()
+        return cls(vertex_id, vertex_input, vertex_script)
+
+    def params(self):
+        """ 转换好类型的参数值，每次返回一份新的 """
+        if self._error is not None:
+            raise self._error
+        return dict(self._params)
+
+    def render(self, params: dict):
+        return render_template(self.segments, params)
+
+
+# 顶点 id -> 执行计划，修改、删除顶点时要清掉
+plans = TopologyCache(config.PLAN_CACHE_SIZE, VertexPlan.load)
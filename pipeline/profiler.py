@@ -0,0 +1,139 @@
+from sqlalchemy import event
+from pipeline import config
+from loguru import logger
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+"""
+SQL 往返统计，按逻辑操作（start_pipeline、save_track、getdag ...）记录查询次数、行数、耗时
+同一次操作中相同的语句执行多次（典型的 N+1）会被标记出来
+只在 config.SQL_PROFILE 打开时挂到 engine 上，关闭时 profiled 装饰器只多一次属性判断
+"""
+
+OTHER = 'other'  # 不在任何操作中的查询
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.repeats = {}  # 语句 -> 一次操作中出现的最多次数，只记录超过阈值的
+
+
+class SQLProfiler:
+    def __init__(self, repeat_threshold=config.SQL_PROFILE_REPEAT):
+        self.enabled = False
+        self.repeat_threshold = repeat_threshold
+        self._local = threading.local()  # 每个线程自己的操作栈
+        self._lock = threading.Lock()
+        self._stats = defaultdict(OperationStats)
+
+    def attach(self, engine):
+        """ 在 engine 上注册游标事件，之后这个 engine 上的所有语句都会被统计 """
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        self.enabled = True
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['profiler_start'] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop('profiler_start', time.perf_counter())
+        rows = max(cursor.rowcount, 0)  # SELECT 在部分驱动下是 -1
+        stack = self._stack()
+        if stack:  # 归到最里层的操作
+            frame = stack[-1]
+            frame['queries'] += 1
+            frame['rows'] += rows
+            frame['seconds'] += elapsed
+            frame['statements'][statement] += 1
+        else:
+            with self._lock:
+                stats = self._stats[OTHER]
+                stats.queries += 1
+                stats.rows += rows
+                stats.seconds += elapsed
+
+    @contextmanager
+    def operation(self, name):
+        """ 一次逻辑操作，其中执行的语句都记在 name 下 """
+        if not self.enabled:
+            yield
+            return
+        frame = {'queries': 0, 'rows': 0, 'seconds': 0.0, 'statements': Counter()}
+        stack = self._stack()
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            self._record(name, frame)
+
+    def _record(self, name, frame):
+        repeated = {s: n for s, n in frame['statements'].items() if n >= self.repeat_threshold}
+        with self._lock:
+            stats = self._stats[name]
+            stats.calls += 1
+            stats.queries += frame['queries']
+            stats.rows += frame['rows']
+            stats.seconds += frame['seconds']
+            for statement, n in repeated.items():
+                if n > stats.repeats.get(statement, 0):
+                    if statement not in stats.repeats:  # 每条语句只警告一次
+                        logger.warning(f'{name} 中同一条语句执行了 {n} 次：{" ".join(statement.split())[:200]}')
+                    stats.repeats[statement] = n
+
+    def stats(self):
+        """ {操作名: {'calls', 'queries', 'rows', 'seconds', 'repeats'}} """
+        with self._lock:
+            return {name: {'calls': s.calls, 'queries': s.queries, 'rows': s.rows, 'seconds': s.seconds,
+                           'repeats': dict(s.repeats)}
+                    for name, s in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def report(self):
+        """ 文本形式的汇总，按总耗时从大到小 """
+        stats = sorted(self.stats().items(), key=lambda item: item[1]['seconds'], reverse=True)
+        lines = [f'{"operation":<24}{"calls":>8}{"queries":>10}{"q/call":>8}{"rows":>10}{"ms":>10}']
+        for name, s in stats:
+            per_call = s['queries'] / s['calls'] if s['calls'] else 0
+            lines.append(f'{name:<24}{s["calls"]:>8}{s["queries"]:>10}{per_call:>8.1f}{s["rows"]:>10}'
+                         f'{s["seconds"] * 1000:>10.1f}')
+        for name, s in stats:
+            for statement, n in sorted(s['repeats'].items(), key=lambda item: -item[1]):
+                lines.append(f'[重复] {name} x{n}: {" ".join(statement.split())[:200]}')
+        return '\n'.join(lines)
+
+
+# 全局的 SQL 统计，pipeline 和 web 的 engine 共用，操作栈按线程区分
+profiler = SQLProfiler()
+
+
+def profiled(name):
+    """ 装饰器，把函数的一次调用记为一次名为 name 的操作 """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            with profiler.operation(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
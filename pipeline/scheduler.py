@@ -0,0 +1,190 @@
+from pipeline import config
+from collections import Counter
+from itertools import count
+import threading
+import heapq
+import time
+import os
+
+
+def host_memory_mb():
+    """ 当前可用内存，取不到返回 0 表示不限制 """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+class Job:
+    """ 等待运行的 track，参数和脚本已经准备好了 """
+    __slots__ = ('track_id', 'pipeline_id', 'graph_id', 'vertex_id', 'params', 'script', 'cpu', 'mem_mb', 'rank',
+                 'started_at', 'result_key', 'cached', 'blocked_since')
+
+    def __init__(self, track_id, pipeline_id, graph_id, vertex_id, params, script, resources=None, rank=0.0,
+                 defaults=None):
+        self.track_id = track_id
+        self.pipeline_id = pipeline_id
+        self.graph_id = graph_id
+        self.vertex_id = vertex_id
+        self.params = params
+        self.script = script
+        self.rank = rank  # 到终点的剩余路径长度，同一个 pipeline 中越大越先运行
+        self.started_at = None
+        self.result_key = None  # 可以缓存的顶点，运行结果的内容地址
+        self.cached = False  # 是否直接使用了缓存的结果
+        self.blocked_since = None  # 排在队首但资源不够、开始等待的时间
+        # 顶点声明的 {"cpu": 4, "mem_mb": 2048}，没有声明的按执行引擎的默认占用
+        resources = {**(config.DEFAULT_RESOURCES if defaults is None else defaults), **(resources or {})}
+        self.cpu = float(resources['cpu'])
+        self.mem_mb = int(resources['mem_mb'])
+
+
+class Scheduler:
+    """
+    多个 pipeline 之间的加权公平调度
+    每个 pipeline 一个队列和一个虚拟时间，每运行一个 track 虚拟时间增加 1 / 权重，每次取虚拟时间最小的 pipeline
+    权重 = priority + 1，一个很宽的 pipeline 也不会把其他 pipeline 饿死
+    同一个 pipeline 中按关键路径排序，剩余路径最长的先运行
+    同时限制全局、每个图、每个 pipeline 的并发数
+    每个 track 按声明的 cpu、内存占用本机的资源，放得下才运行；一个 track 超过全部资源时，只能在没有其他 track 运行时单独运行
+    资源需求大的 track 可能一直被小的插队，排在队首等了 reserve_after 秒以上时预留资源：
+    不再放入其他 track，运行中的结束后先给它，等得最久的先预留
+    """
+
+    def __init__(self, workers=config.WORKERS, pipeline_cap=config.PIPELINE_MAX_CONCURRENCY,
+                 graph_cap=config.GRAPH_MAX_CONCURRENCY, graph_caps=config.GRAPH_MAX_CONCURRENCY_OVERRIDES,
+                 cpu=config.CPU_CAPACITY, mem_mb=config.MEM_CAPACITY_MB,
+                 reserve_after=config.SCHEDULER_RESERVE_AFTER):
+        self.workers = workers
+        self._reserve_after = reserve_after
+        self.cpu = cpu or os.cpu_count() or 1
+        self.mem_mb = mem_mb or host_memory_mb()  # 0 表示不限制内存
+        self.cpu_used = 0
+        self.mem_used = 0
+        self._pipeline_cap = pipeline_cap
+        self._graph_cap = graph_cap
+        self._graph_caps = graph_caps
+        self._cond = threading.Condition()
+        self._queues = {}  # pipeline.id -> 堆 [(-rank, 序号, Job)]
+        self._seq = count()  # rank 相同时按放入的先后
+        self._weights = {}  # pipeline.id -> 权重
+        self._vtimes = {}  # pipeline.id -> 虚拟时间
+        self._clock = 0  # 最近一次调度的虚拟时间，新来的 pipeline 从这里开始，不能因为之前空闲而占便宜
+        self._running = 0
+        self._by_pipeline = Counter()
+        self._by_graph = Counter()
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    @staticmethod
+    def _head(q):
+        return q[0][2]
+
+    @property
+    def running(self):
+        return self._running
+
+    def push(self, job: Job, priority=0):
+        with self._cond:
+            q = self._queues.get(job.pipeline_id)
+            if q is None:
+                q = self._queues[job.pipeline_id] = []
+                self._vtimes[job.pipeline_id] = self._clock
+            self._weights[job.pipeline_id] = max(priority, 0) + 1
+            heapq.heappush(q, (-job.rank, next(self._seq), job))
+            self._cond.notify()
+
+    def _fits(self, job: Job):
+        if self._running == 0:  # 什么都没运行时总能放下，否则超过资源的 track 永远不会运行
+            return True
+        if self.cpu_used + job.cpu > self.cpu:
+            return False
+        return not self.mem_mb or self.mem_used + job.mem_mb <= self.mem_mb
+
+    def _eligible(self, pipeline_id, graph_id):
+        if self._pipeline_cap and self._by_pipeline[pipeline_id] >= self._pipeline_cap:
+            return False
+        cap = self._graph_caps.get(graph_id, self._graph_cap)
+        if cap and self._by_graph[graph_id] >= cap:
+            return False
+        return True
+
+    def _select(self):
+        """ 在没有超过限制的 pipeline 中，取虚拟时间最小的；有等待太久的 track 时只等它 """
+        if self._running >= self.workers:
+            return None
+        now = time.monotonic()
+        best = None
+        starving = None  # 等待超过 reserve_after 的队首 track 中等得最久的
+        for pipeline_id, q in self._queues.items():
+            head = self._head(q)
+            if not self._eligible(pipeline_id, head.graph_id):
+                continue
+            if head.blocked_since is not None and now - head.blocked_since >= self._reserve_after:
+                if starving is None or head.blocked_since < self._head(self._queues[starving]).blocked_since:
+                    starving = pipeline_id
+            if not self._fits(head):
+                if head.blocked_since is None:
+                    head.blocked_since = now
+                continue
+            if best is None or (self._vtimes[pipeline_id], pipeline_id) < (self._vtimes[best], best):
+                best = pipeline_id
+        if starving is not None:  # 预留资源，放得下就运行它，放不下就什么都不放，等运行中的结束
+            return starving if self._fits(self._head(self._queues[starving])) else None
+        return best
+
+    def pop(self):
+        """ 阻塞到有可以运行的 track，返回 Job；close 之后返回 None """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                pipeline_id = self._select()
+                if pipeline_id is not None:
+                    break
+                self._cond.wait()
+
+            q = self._queues[pipeline_id]
+            job = heapq.heappop(q)[2]
+            self._clock = self._vtimes[pipeline_id]
+            self._vtimes[pipeline_id] += 1 / self._weights[pipeline_id]
+            if not q:  # 队列空了就删掉，下次再来从当前虚拟时间开始
+                del self._queues[pipeline_id], self._vtimes[pipeline_id], self._weights[pipeline_id]
+
+            self._running += 1
+            self.cpu_used += job.cpu
+            self.mem_used += job.mem_mb
+            self._by_pipeline[job.pipeline_id] += 1
+            self._by_graph[job.graph_id] += 1
+            return job
+
+    def release(self, job: Job):
+        """ track 运行结束，归还名额 """
+        with self._cond:
+            self._running -= 1
+            self.cpu_used -= job.cpu
+            self.mem_used -= job.mem_mb
+            if not self._running:  # 小数累加有误差，全部结束时归零
+                self.cpu_used = self.mem_used = 0
+            self._by_pipeline[job.pipeline_id] -= 1
+            self._by_graph[job.graph_id] -= 1
+            if not self._by_pipeline[job.pipeline_id]:
+                del self._by_pipeline[job.pipeline_id]
+            if not self._by_graph[job.graph_id]:
+                del self._by_graph[job.graph_id]
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -1,8 +1,15 @@
-from pipeline.model import db, Graph, Vertex, Edge
+from pipeline.model import db, Graph, Vertex, Edge, Pipeline, STATE_NAMES
+from sqlalchemy import func
+from pipeline.topology import topologies, orders
+from pipeline.plan import plans
 from loguru import logger
+from pipeline.csr import CSRGraph, levels, has_cycle
+from pipeline import config
+from pipeline.profiler import profiled
 from functools import wraps
-import copy
-from collections import defaultdict
+import numpy as np
+import simplejson
+import os
 
 
 def transactional(fn):
@@ -42,18 +49,34 @@ def add_vertex(graph: Graph, name, input=None, script=None):
     v.graph_id = graph.id
 
     db.session.add(v)
+    topologies.invalidate(graph.id)
     return v
 
 
 @transactional
 def add_edge(graph: Graph, tail: Vertex, head: Vertex):
-    """ 增加边 """
-    e = Edge()
-    e.graph_id = graph.id
-    e.tail = tail.id
-    e.head = head.id
-
-    db.session.add(e)
+    """ 增加边，会形成环路的边直接拒绝，并同时维护 Graph.checked """
+    order = orders.get(graph.id)
+    with order.lock:
+        if not order.add_edge(tail.id, head.id):  # 增量检查，只看受影响的顶点
+            raise ValueError(f'{tail.name} -> {head.name} 会形成环路')
+
+        e = Edge()
+        e.graph_id = graph.id
+        e.tail = tail.id
+        e.head = head.id
+
+        db.session.add(e)
+        try:
+            db.session.flush()
+        except Exception:
+            orders.invalidate(graph.id)  # 内存中已经加了这条边，写库失败要丢掉，下次重新加载
+            raise
+
+    # 有边并且没有环路，就符合 DAG（没有边的图业务上不用，见 check_graph）
+    db.session.query(Graph).filter(Graph.id == graph.id).update({Graph.checked: 1 if order.acyclic else 0},
+                                                                  synchronize_session=False)
+    topologies.invalidate(graph.id)
     return e
 
 
@@ -64,9 +87,133 @@ def del_vertex(v_id):
     if v:  # 找到顶点后，删除关联的边，然后删除顶点
         db.session.query(Edge).filter((Edge.tail == v.id) | (Edge.head == v.id)).delete()  # 删除边
         db.session.delete(v)  # 删除顶点
+        topologies.invalidate(v.graph_id)
+        orders.invalidate(v.graph_id)
+        plans.invalidate(v.id)
+    return v
+
+
+@transactional
+def update_vertex(v_id, input=None, script=None):
+    """ 修改顶点的 input、script，为 None 的不修改，之后准备的 track 使用新的定义 """
+    v = db.session.query(Vertex).get(v_id)
+    if v:
+        if input is not None:
+            v.input = input
+        if script is not None:
+            v.script = script
+        db.session.add(v)
+        plans.invalidate(v.id)  # 执行计划按顶点 id 缓存，修改后重新编译
     return v
 
 
+"""
+图的描述文件，JSON 或 YAML，input、script 可以写成对象，也可以写成字符串
+name: test1
+desc: 测试
+vertexes:
+  - name: A
+    input: {ip: {type: str, required: true, default: 127.0.0.1}}
+    script: {script: "echo A\nping {ip} -c 2"}
+  - name: B
+    script: {script: echo B}
+edges:
+  - [A, B]
+"""
+
+
+def _read_spec(spec):
+    """ spec 可以是 dict、文件路径、JSON 或 YAML 文本 """
+    if isinstance(spec, dict):
+        return spec
+    if os.path.exists(spec):
+        with open(spec, encoding='utf-8') as f:
+            spec = f.read()
+    try:
+        return simplejson.loads(spec)
+    except ValueError:
+        import yaml  # 只有使用 YAML 时才需要安装 PyYAML
+        return yaml.safe_load(spec)
+
+
+def _dumps_field(value):
+    return value if value is None or isinstance(value, str) else simplejson.dumps(value)
+
+
+def _loads_field(value):
+    try:
+        return simplejson.loads(value) if value else value
+    except ValueError:
+        return value
+
+
+@profiled('load_graph')
+@transactional
+def load_graph(spec):
+    """
+    从描述文件导入一个图，返回 graph.id
+    先在内存中检查名称、边和环路，全部通过才写库，顶点和边都是批量 insert，只有一个事务
+    """
+    spec = _read_spec(spec)
+    vertexes = spec.get('vertexes') or []
+    edges = spec.get('edges') or []
+
+    names = [v['name'] for v in vertexes]
+    if len(set(names)) != len(names):
+        raise ValueError('顶点名称不能重复')
+    index = {name: i for i, name in enumerate(names)}
+    for tail, head in edges:
+        if tail not in index or head not in index:
+            raise ValueError(f'边 {tail} -> {head} 的顶点不存在')
+    g = CSRGraph(len(names), [index[t] for t, _ in edges], [index[h] for _, h in edges])
+    if has_cycle(g):
+        raise ValueError('这个图不符合 DAG')
+
+    result = db.session.execute(Graph.__table__.insert().values(
+        name=spec['name'], desc=spec.get('desc'), checked=1 if edges else 0, sealed=0))  # 没有边的图业务上不用
+    graph_id = result.inserted_primary_key[0]
+
+    rows = [{'graph_id': graph_id, 'name': v['name'], 'input': _dumps_field(v.get('input')),
+             'script': _dumps_field(v.get('script'))} for v in vertexes]
+    for start in range(0, len(rows), config.BULK_INSERT_ROWS):
+        db.session.execute(Vertex.__table__.insert(), rows[start:start + config.BULK_INSERT_ROWS])
+
+    # 批量 insert 拿不到每行的 id，用名称查回来，同一个图中名称不重复
+    ids = dict(db.session.query(Vertex.name, Vertex.id).filter(Vertex.graph_id == graph_id))
+    rows = [{'graph_id': graph_id, 'tail': ids[tail], 'head': ids[head]} for tail, head in edges]
+    for start in range(0, len(rows), config.BULK_INSERT_ROWS):
+        db.session.execute(Edge.__table__.insert(), rows[start:start + config.BULK_INSERT_ROWS])
+
+    return graph_id
+
+
+def export_graph(g_id, path=None):
+    """ 导出为 load_graph 可以导入的 dict，指定 path 时按扩展名写成 JSON 或 YAML 文件 """
+    graph = db.session.query(Graph).get(g_id)
+    vertexes = db.session.query(Vertex.id, Vertex.name, Vertex.input, Vertex.script) \
+        .filter(Vertex.graph_id == g_id).order_by(Vertex.id).all()
+    names = {v_id: name for v_id, name, _, _ in vertexes}
+    edges = db.session.query(Edge.tail, Edge.head).filter(Edge.graph_id == g_id).order_by(Edge.id)
+
+    spec = {
+        'name': graph.name,
+        'desc': graph.desc,
+        'vertexes': [{'name': name, 'input': _loads_field(inp), 'script': _loads_field(script)}
+                     for _, name, inp, script in vertexes],
+        'edges': [[names[tail], names[head]] for tail, head in edges],
+    }
+    db.session.commit()
+
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            if path.endswith(('.yml', '.yaml')):
+                import yaml
+                yaml.safe_dump(spec, f, allow_unicode=True, sort_keys=False)
+            else:
+                simplejson.dump(spec, f, ensure_ascii=False, indent=2)
+    return spec
+
+
 """
 ##### 提取出指定 graph 中入度为 0 的顶点的 SQL 语句
 左 join 方式的 SQL：
@@ -81,93 +228,43 @@ SELECT * FROM vertex WHERE graph_id =1 AND vertex.id NOT IN (SELECT edge.head fr
 """
 
 
-# kahn 算法实现(卡恩)
-# 效率低，太多迭代，建议使用下面经过优化的
-def check_graph(graph: Graph) -> bool:
-    query = db.session.query(Vertex).filter(Vertex.graph_id == graph.id)
-    vertexes = [x for x in query]
-    query = db.session.query(Edge).filter(Edge.graph_id == graph.id)
-    edges = [x for x in query]
-
-    if not edges or not vertexes:
-        return False
-
-    while vertexes:
-        v_list = copy.copy(vertexes)
-
-        for e in edges:
-            for v in v_list:
-                if e.head == v.id:
-                    v_list.remove(v)
-        else:
-            if not v_list:
-                return False
-
-        e_list = []
-        for v in v_list:
-            for e in edges:
-                if e.tail == v.id:
-                    e_list.append(e)
-
-        for e in e_list:
-            edges.remove(e)
-        for v in v_list:
-            vertexes.remove(v)
-    else:
-        if len(vertexes) + len(edges) == 0:
-            return True
-        else:
-            return False
-
-
-# kahn 算法实现(卡恩)优化后
-def check_graph(graph: Graph) -> bool:
-    query = db.session.query(Vertex).filter(Vertex.graph_id == graph.id)
-    vertexes = {v.id for v in query}
-    query = db.session.query(Edge).filter(Edge.graph_id == graph.id)
-    edges = defaultdict(list)
-
-    if not vertexes:  # 如果没有顶点，直接错误
-        return False
-
-    ids = set()  # 有入度的顶点
-    for edge in query:
-        edges[edge.tail].append((edge.tail, edge.head))
-        ids.add(edge.head)
-    # 生成边的集合，以起始的顶点为 key  { 1: [(1, 2), (1, 3)], 2: [(2, 4)], 3: [(3, 2)] }
-
-    if len(edges) == 0:  # 如果没有边，虽然也是 DAG，但是业务上不用
-        return False
+def _check_graphs(query):
+    """
+    批量检查多个图是否符合 DAG，query 是 Graph.id 的查询
+    所有图的顶点、边各只查一次，拼成一个大的 CSR 图，用向量化的 kahn 算法一次算完
+    返回 {graph.id: 是否符合 DAG}
+    """
+    ids = sorted(g_id for g_id, in query)
+    if not ids:
+        return {}
+    graphs = query.subquery()
+    vertexes = np.array(db.session.query(Vertex.id, Vertex.graph_id)
+                        .join(graphs, Vertex.graph_id == graphs.c.id).all(), dtype=np.int64).reshape(-1, 2)
+    edges = np.array(db.session.query(Edge.tail, Edge.head, Edge.graph_id)
+                     .join(graphs, Edge.graph_id == graphs.c.id).all(), dtype=np.int64).reshape(-1, 3)
 
-    # 如果 edges 不为空，一定有 ids，也就是有入度的顶点一定会有
-    while edges:
-        zds = vertexes - ids  # 没有入度的顶点 = 全部点 - 有入度的点
+    g, vertex_ids = CSRGraph.from_ids(vertexes[:, 0], edges[:, 0], edges[:, 1])
+    level = levels(g)  # 在环上或者环后边的顶点为 -1
 
-        if len(zds):  # zds 为 0 说明没有找到入度为 0 的顶点，算法终止
-            for zd in zds:
-                if zd in edges:  # 有可能顶点没有出度
-                    del edges[zd]
-        else:
-            break
+    ids = np.array(ids, dtype=np.int64)
+    graph_index = np.searchsorted(ids, vertexes[np.argsort(vertexes[:, 0]), 1])  # 每个顶点属于第几个图
+    has_vertex = np.bincount(graph_index, minlength=len(ids)) > 0
+    has_edge = np.bincount(np.searchsorted(ids, edges[:, 2]), minlength=len(ids)) > 0  # 没有边的图业务上不用
+    has_cycle = np.bincount(graph_index[level < 0], minlength=len(ids)) > 0
 
-        vertexes = ids
-        ids = set()  # 重新寻找有入度的顶点
+    ok = has_vertex & has_edge & ~has_cycle
+    return dict(zip(ids.tolist(), ok.tolist()))
 
-        for lst in edges.values():
-            for edge in lst:
-                ids.add(edge[1])
 
-    # 如果边集为空，剩下所有顶点都是入度为 0 的，没必要在多次迭代删除顶点
-    if len(edges) == 0:
-
-        # 检验通过，修改checked字段为1
+def check_graph(graph: Graph) -> bool:
+    """ 检查一个图是否符合 DAG，通过则修改 checked 字段为 1 """
+    result = _check_graphs(db.session.query(Graph.id).filter(Graph.id == graph.id))
+    if result.get(graph.id):
         try:
-            graph = db.session.query(Graph).get(graph.id)
-            if graph:
-                graph.checked = 1
-                db.session.add(graph)
-                db.session.commit()
-                return True
+            db.session.query(Graph).filter(Graph.id == graph.id).update({Graph.checked: 1},
+                                                                        synchronize_session=False)
+            db.session.commit()
+            return True
         except Exception as e:
             logger.error(e)
             db.session.rollback()
@@ -177,10 +274,28 @@ def check_graph(graph: Graph) -> bool:
 
 
 # 检查所有 checked 字段为 0 的 Graph 是否符合 DAG
+@profiled('check_graph_all')
 def check_graph_all():
-    query = db.session.query(Graph).filter(Graph.checked == 0)
-    for graph in query:
-        if check_graph(graph):
-            logger.info(f'check dag done: {graph.name} yes dag')
-        else:
-            logger.info(f'check dag done: {graph.name} is not dag')
+    result = _check_graphs(db.session.query(Graph.id).filter(Graph.checked == 0))
+    passed = [g_id for g_id, ok in result.items() if ok]
+    try:
+        if passed:  # 检验通过的一次全部修改
+            db.session.query(Graph).filter(Graph.id.in_(passed)).update({Graph.checked: 1},
+                                                                        synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        logger.error(e)
+        db.session.rollback()
+        raise e
+
+    logger.info(f'check dag done: {len(passed)} yes dag, not dag: {[g_id for g_id, ok in result.items() if not ok]}')
+    return result
+
+
+def count_pipelines():
+    """ 各个状态的 pipeline 数，{(状态名,): 数量}，给监控指标使用 """
+    try:
+        query = db.session.query(Pipeline.state, func.count(Pipeline.id)).group_by(Pipeline.state)
+        return {(STATE_NAMES.get(state, str(state)),): n for state, n in query}
+    finally:
+        db.remove()  # 在 /metrics 的请求线程中调用，用完就归还
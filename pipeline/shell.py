@@ -0,0 +1,120 @@
+from pipeline import config
+from pipeline.output import OutputCapture
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
+from shlex import quote
+from uuid import uuid4
+import tempfile
+import queue
+
+
+def wrap_script(script: str, fd):
+    """
+    在脚本前边加一个 ERR trap，命令失败时把行号和退出码写到 fd，整个脚本在一个 shell 中执行也能知道哪一行失败了
+    脚本内容原样保留，heredoc、case、\\ 续行都不受影响
+    哪些失败会触发和 set -e 的规则一样：if 条件、&& || 中间的命令失败不算
+    行号从 trap 所在的行算起，bash -c、eval、常驻 shell 中都是脚本自己的行号
+    """
+    return f"__line=$LINENO; trap 'echo \"$((LINENO - __line)) $?\" >&{fd}' ERR\n{script}"
+
+
+def parse_statuses(text: str):
+    """ '2 1\\n7 127\\n' -> [(2, 1), (7, 127)]，格式不对的行跳过（比如脚本自己往 fd 写了东西） """
+    statuses = []
+    for line in text.splitlines():
+        try:
+            no, code = line.split()
+            statuses.append((int(no), int(code)))
+        except ValueError:
+            continue
+    return statuses
+
+
+def run_lines(script: str, capture: OutputCapture):
+    """ 每一行单独启动一个 shell，输出直接写入 track 的日志文件 """
+    statuses = []
+    for no, line in enumerate(script.splitlines(), 1):  # 按行分割
+        p = Popen(line, shell=True, stdin=DEVNULL, stdout=capture, stderr=STDOUT)
+        statuses.append((no, p.wait()))  # 阻塞等，code 为 0 是正确执行
+    capture.collect()
+    return 0, statuses
+
+
+def run_session(script: str, capture: OutputCapture, shell=config.SHELL):
+    """
+    整个脚本在一个 shell 进程中执行，每行的退出码写到单独的临时文件
+    输出和退出码都不走管道：脚本中放到后台的进程（sleep 5 &）会继承管道，读到 EOF 要等它结束，
+    直接写文件只需要等 shell 本身退出
+    """
+    with tempfile.TemporaryFile() as status:
+        fd = status.fileno()
+        p = Popen([shell, '-c', wrap_script(script, fd)], stdin=DEVNULL, stdout=capture, stderr=STDOUT,
+                  pass_fds=(fd,))
+        code = p.wait()
+        status.seek(0)
+        statuses = parse_statuses(status.read().decode())
+    capture.collect()
+    return code, statuses
+
+
+class ShellWorker:
+    """
+    常驻的 shell 进程，通过 stdin 接收脚本
+    每个脚本在子 shell 中 eval，互不影响；输出直接追加到 track 的日志文件，stdout 只用来传回退出码
+    """
+
+    def __init__(self, shell=config.SHELL):
+        self._proc = Popen([shell], stdin=PIPE, stdout=PIPE, stderr=DEVNULL, text=True, bufsize=1)
+
+    def run(self, script: str, path):
+        token = uuid4().hex  # 结束标记，同时用作 heredoc 的分隔符，脚本内容原样传过去
+        self._proc.stdin.write(
+            f"(\n"
+            f"exec 3>&1 >>{quote(path)} 2>&1 </dev/null\n"
+            f"IFS= read -r -d '' __script <<'{token}'\n"
+            f"{wrap_script(script, 3)}\n"
+            f"{token}\n"
+            f"eval \"$__script\"\n"
+            f")\n"
+            f"echo \"{token} $?\"\n"
+        )
+        self._proc.stdin.flush()
+
+        lines = []
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                raise RuntimeError('shell worker exited')
+            if line.startswith(token):
+                return int(line.split()[1]), parse_statuses(''.join(lines))
+            lines.append(line)
+
+    def close(self):
+        self._proc.kill()
+        self._proc.wait()
+
+
+class ShellPool:
+    """ 预先启动的常驻 shell 池，数量和执行线程数一致，每个线程都有一个可用的 shell """
+
+    def __init__(self, size, shell=config.SHELL):
+        self._shell = shell
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(ShellWorker(shell))
+
+    def run(self, script: str, capture: OutputCapture):
+        worker = self._idle.get()  # 没有空闲的就阻塞等
+        try:
+            code, statuses = worker.run(script, capture.path)
+        except Exception:
+            worker.close()  # 坏掉的进程换一个新的
+            worker = ShellWorker(self._shell)
+            raise
+        finally:
+            self._idle.put(worker)
+        capture.collect()
+        return code, statuses
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().close()
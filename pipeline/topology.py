@@ -0,0 +1,196 @@
+from pipeline.model import db, Vertex, Edge
+from pipeline import config
+from collections import OrderedDict, defaultdict
+import threading
+
+
+class Topology:
+    """
+    编译后的图结构，图被 sealed 之后就不会再变，所以编译一次就可以反复使用
+    顶点全部换成从 0 开始的下标，邻接表、入度都是按下标存的列表
+    """
+
+    def __init__(self, graph_id, vertexes, edges):
+        # vertexes  [(vertex.id, vertex.name), ...]
+        # edges     [(edge.tail, edge.head), ...]
+        self.graph_id = graph_id
+        self.ids = [v_id for v_id, _ in vertexes]  # 下标 -> 顶点 id
+        self.names = [name for _, name in vertexes]  # 下标 -> 顶点名称
+        self.index = {v_id: i for i, v_id in enumerate(self.ids)}  # 顶点 id -> 下标
+
+        n = len(self.ids)
+        self.successors = [[] for _ in range(n)]  # 下标 -> 后继顶点的下标
+        self.predecessors = [[] for _ in range(n)]  # 下标 -> 前置顶点的下标
+        self.indegree = [0] * n  # 入度
+        for tail, head in edges:
+            t, h = self.index[tail], self.index[head]
+            self.successors[t].append(h)
+            self.predecessors[h].append(t)
+            self.indegree[h] += 1
+
+        self.sources = [i for i, d in enumerate(self.indegree) if d == 0]  # 入度为 0 的顶点下标
+
+        # 拓扑序，kahn 算法；图在使用前已经检查过是 DAG
+        indegree = list(self.indegree)
+        zds = list(self.sources)
+        self.order = []
+        while zds:
+            i = zds.pop()
+            self.order.append(i)
+            for n in self.successors[i]:
+                indegree[n] -= 1
+                if indegree[n] == 0:
+                    zds.append(n)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, graph_id):
+        """ 从数据库加载，只查两次 """
+        vertexes = db.session.query(Vertex.id, Vertex.name).filter(Vertex.graph_id == graph_id) \
+            .order_by(Vertex.id).all()
+        edges = db.session.query(Edge.tail, Edge.head).filter(Edge.graph_id == graph_id).all()
+        return cls(graph_id, vertexes, edges)
+
+
+class TopologyCache:
+    """ 以 graph.id 为 key 的 LRU 缓存，loader 负责从数据库加载一个图，顶点的执行计划也用它缓存（key 是 vertex.id） """
+
+    def __init__(self, maxsize=128, loader=Topology.load):
+        self._maxsize = maxsize
+        self._loader = loader
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, graph_id):
+        with self._lock:
+            topology = self._cache.get(graph_id)
+            if topology is not None:
+                self._cache.move_to_end(graph_id)
+                return topology
+        return self.compile(graph_id)
+
+    def compile(self, graph_id):
+        """ 重新从数据库编译，并放入缓存 """
+        topology = self._loader(graph_id)
+        with self._lock:
+            self._cache[graph_id] = topology
+            self._cache.move_to_end(graph_id)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)  # 淘汰最久没用的
+        return topology
+
+    def invalidate(self, graph_id):
+        """ 图还没有 sealed 时结构会变，修改后要清掉缓存 """
+        with self._lock:
+            self._cache.pop(graph_id, None)
+
+
+class TopologicalOrder:
+    """
+    建图过程中增量维护的拓扑序（Pearce–Kelly 算法）
+    加边 tail -> head 时，如果 tail 已经排在 head 前面，什么都不用做；
+    否则只在 [ord[head], ord[tail]] 区间内向前、向后各搜一次，能从 head 走到 tail 就是环，不是环就只调整这个区间内的顶点
+    已经有环的图没有拓扑序，ord 为 None，只记录边，不再检查
+    """
+
+    def __init__(self, vertexes, edges):
+        # vertexes  [vertex.id, ...]
+        # edges     [(edge.tail, edge.head), ...]
+        self.lock = threading.Lock()
+        self.successors = defaultdict(set)
+        self.predecessors = defaultdict(set)
+        self.edges = 0
+        for tail, head in edges:
+            self._link(tail, head)
+
+        # 用 kahn 算法得到初始的拓扑序
+        indegree = {v: len(self.predecessors[v]) for v in vertexes}
+        zds = [v for v, d in indegree.items() if d == 0]
+        order = []
+        while zds:
+            v = zds.pop()
+            order.append(v)
+            for n in self.successors[v]:
+                indegree[n] -= 1
+                if indegree[n] == 0:
+                    zds.append(n)
+
+        self.ord = {v: i for i, v in enumerate(order)} if len(order) == len(indegree) else None
+        self._next = len(order)
+
+    @property
+    def acyclic(self):
+        return self.ord is not None
+
+    def _link(self, tail, head):
+        if head not in self.successors[tail]:
+            self.successors[tail].add(head)
+            self.predecessors[head].add(tail)
+            self.edges += 1
+
+    def _position(self, v):
+        if v not in self.ord:  # 加载之后新增的顶点，放到最后
+            self.ord[v] = self._next
+            self._next += 1
+        return self.ord[v]
+
+    def add_edge(self, tail, head) -> bool:
+        """ 加边，会形成环路时返回 False，并且不做任何修改 """
+        if self.ord is None:
+            self._link(tail, head)
+            return True
+        if tail == head:
+            return False
+
+        lb, ub = self._position(head), self._position(tail)
+        if lb < ub:  # head 排在 tail 前面，需要检查和调整
+            forward = self._forward(head, tail, ub)
+            if forward is None:
+                return False
+            self._reorder(self._backward(tail, lb), forward)
+
+        self._link(tail, head)
+        return True
+
+    def _forward(self, start, target, ub):
+        """ 从 head 往后搜，只看排在 tail 之前的顶点，碰到 tail 说明有环 """
+        visited, stack = {start}, [start]
+        while stack:
+            for w in self.successors[stack.pop()]:
+                if w == target:
+                    return None
+                if w not in visited and self.ord[w] < ub:
+                    visited.add(w)
+                    stack.append(w)
+        return visited
+
+    def _backward(self, start, lb):
+        """ 从 tail 往前搜，只看排在 head 之后的顶点 """
+        visited, stack = {start}, [start]
+        while stack:
+            for w in self.predecessors[stack.pop()]:
+                if w not in visited and self.ord[w] > lb:
+                    visited.add(w)
+                    stack.append(w)
+        return visited
+
+    def _reorder(self, backward, forward):
+        """ 受影响的顶点占用的位置不变，能到达 tail 的全部排到从 head 出发能到达的前面 """
+        vertexes = sorted(backward, key=self.ord.get) + sorted(forward, key=self.ord.get)
+        slots = sorted(self.ord[v] for v in vertexes)
+        for v, i in zip(vertexes, slots):
+            self.ord[v] = i
+
+    @classmethod
+    def load(cls, graph_id):
+        vertexes = [v_id for v_id, in db.session.query(Vertex.id).filter(Vertex.graph_id == graph_id)]
+        edges = db.session.query(Edge.tail, Edge.head).filter(Edge.graph_id == graph_id).all()
+        return cls(vertexes, edges)
+
+
+# 全局的图结构缓存
+topologies = TopologyCache(config.TOPOLOGY_CACHE_SIZE)
+# 建图时增量检查环路用的拓扑序
+orders = TopologyCache(config.TOPOLOGY_CACHE_SIZE, TopologicalOrder.load)
@@ -0,0 +1,40 @@
+import argparse
+import threading
+from pipeline import config
+
+"""
+执行器进程的入口，不改动数据库中已有的数据
+启动时继续执行状态是 RUNNING 的 pipeline（进程重启前没跑完的），可以单独输出 /metrics、把状态变化转发给 WEB
+    python -m pipeline.worker --metrics-port 9108 --events-port 9109
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', type=int, default=config.WORKERS, help='同时运行的 track 数')
+parser.add_argument('--metrics-port', type=int, default=config.METRICS_PORT, help='单独输出 /metrics 的端口，0 不启动')
+parser.add_argument('--events-port', type=int, default=config.EVENTS_PORT, help='转发状态变化给 WEB 的端口，0 不转发')
+# 执行器在 import 时创建，所以要先改好配置
+args = parser.parse_args()
+config.WORKERS = args.workers
+
+from pipeline.model import db, Pipeline, STATE_RUNNING
+from loguru import logger
+from pipeline.service import count_pipelines
+from pipeline.executor import executor
+from pipeline import metrics, events
+
+if args.metrics_port:
+    metrics.gauge('pipeline_pipelines', '各个状态的 pipeline 数', ('state',), fn=count_pipelines)
+    metrics.start_http_server(args.metrics_port)
+if args.events_port:  # 单独运行的 WEB 连上来接收状态变化
+    events.start_server(args.events_port)
+
+p_ids = [p_id for p_id, in db.session.query(Pipeline.id).filter(Pipeline.state == STATE_RUNNING)]
+db.session.commit()
+for p_id in p_ids:
+    executor.resume_pipeline(p_id)
+logger.info(f'executor started, resumed pipelines: {p_ids}')
+
+try:
+    threading.Event().wait()
+except KeyboardInterrupt:
+    executor.shutdown()
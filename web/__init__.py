@@ -1,27 +1,112 @@
-from flask import Flask, make_response, render_template, jsonify
-from .service import getdag
+from flask import Flask, Response, make_response, render_template, jsonify, request, abort
+from .service import getdag, pipeline_events
+from .service import list_pipelines, list_tracks, get_track, track_output, parse_states
+from pipeline import metrics
+from pipeline.service import count_pipelines
+from pipeline.profiler import profiler
+from pipeline.output import tail
+from .model import db
 
 web = Flask('pipeline_web')
 
+metrics.gauge('pipeline_pipelines', '各个状态的 pipeline 数', ('state',), fn=count_pipelines)
+
+
+@web.teardown_appcontext
+def remove_session(exception=None):  # 每个请求结束时归还当前线程的 session
+    db.remove()
+
 
 @web.route('/', methods=['GET'])  # 路由，可以指定方法列表，缺省GET
 def index():  # 视图函数
     return render_template('index.html')
 
 
-@web.route('/<int:graphid>')  # index.html 中访问不同的模板页
-def showdag(graphid):
-    return render_template(f'chart{graphid}.html')
+@web.route('/<int:chartid>')  # index.html 中访问不同的模板页，?pipeline= 指定要看的 pipeline
+def showdag(chartid):
+    return render_template(f'chart{chartid}.html', pipeline_id=request.args.get('pipeline', 1, type=int))
+
+
+@web.route('/simple')  # chart1.html 的柱状图数据
+def showsimple():
+    return simplegraph()
+
+
+@web.route('/dag/<int:pipeline_id>')  # pipeline 的 DAG 和各个 track 的状态
+def showajaxdag(pipeline_id):
+    data = getdag(pipeline_id)
+    if data is None:
+        abort(404)
+    # 内容没变时返回 304，浏览器用缓存的，布局本身在服务端按图缓存
+    response = jsonify(data)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@web.route('/tracks/<int:track_id>/output')  # 结束时保存的输出，边解压边返回
+def trackoutput(track_id):
+    stream = track_output(track_id)
+    if stream is None:
+        abort(404)
+    return Response(stream, mimetype='text/plain')
+
+
+@web.route('/tracks/<int:track_id>/tail')  # 运行中查看输出，offset 用上次返回的值，负数表示从末尾往前
+def tailtrack(track_id):
+    offset = request.args.get('offset', 0, type=int)
+    return jsonify(tail(track_id, offset))
+
+
+def history_args():  # 历史记录接口共用的查询参数：state、before、limit
+    try:
+        states = parse_states(request.args.get('state'))
+    except ValueError as e:
+        abort(make_response(jsonify({'message': str(e)}), 400))
+    return {'states': states,
+            'before': request.args.get('before', type=int),
+            'limit': request.args.get('limit', type=int)}
+
+
+@web.route('/pipelines')  # pipeline 历史，?graph=&state=failed,finish&before=&limit=，before 用上一页返回的 next
+def pipelines():
+    return jsonify(list_pipelines(graph_id=request.args.get('graph', type=int), **history_args()))
+
+
+@web.route('/pipelines/<int:pipeline_id>/tracks')
+def pipelinetracks(pipeline_id):
+    return jsonify(list_tracks(pipeline_id=pipeline_id, **history_args()))
+
+
+@web.route('/tracks')  # track 历史，?graph=&state=&before=&limit=
+def tracks():
+    return jsonify(list_tracks(graph_id=request.args.get('graph', type=int), **history_args()))
+
+
+@web.route('/tracks/<int:track_id>')  # 大字段按需取，?fields=input,script,output
+def track(track_id):
+    data = get_track(track_id, request.args.get('fields', '').split(','))
+    if data is None:
+        abort(404)
+    return jsonify(data)
+
+
+@web.route('/pipelines/<int:pipeline_id>/events')  # SSE，运行中的状态变化，WEB 单独运行时从执行器进程转发过来
+def pipelineevents(pipeline_id):
+    return Response(pipeline_events(pipeline_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@web.route('/metrics')  # Prometheus 抓取，执行器和 WEB 在同一个进程时，执行器的指标也在这里
+def showmetrics():
+    return make_response(metrics.REGISTRY.render(), 200, {'Content-Type': metrics.CONTENT_TYPE})
 
 
-@web.route('/dag/<int:graphid>')  # (rule, **options):
-def showajaxdag(graphid):
-    if graphid == 1:
-        return simplegraph()
-    elif graphid == 2:
-        return jsonify(getdag(1))
-    elif graphid == 3:
-        return jsonify(getdag(3))
+@web.route('/debug/sql')  # SQL 往返统计的汇总，config.SQL_PROFILE 打开时才有
+def showsqlprofile():
+    if not profiler.enabled:
+        return make_response('SQL_PROFILE 没有打开\n', 404, {'Content-Type': 'text/plain; charset=utf-8'})
+    return make_response(profiler.report() + '\n', 200, {'Content-Type': 'text/plain; charset=utf-8'})
 
 
 def simplegraph():
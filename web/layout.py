@@ -0,0 +1,93 @@
+from .model import db, Vertex, Edge
+from pipeline.csr import CSRGraph, levels
+from pipeline.topology import TopologyCache
+from pipeline import config
+import numpy as np
+
+"""
+DAG 的分层布局（Sugiyama 风格），前端 ECharts 使用 layout: 'none'，坐标在这里算好
+1. 按拓扑层次分层，层号是到入度为 0 的顶点的最长路径
+2. 每层内按前置（向下扫）、后继（向上扫）位置的重心排序，减少交叉
+3. 层号是 y，层内的顺序是 x，每层居中
+图 sealed 之后结构不会再变，布局按图缓存
+"""
+
+X_GAP = 120
+Y_GAP = 100
+SWEEPS = 4  # 重心排序上下各扫几遍
+
+
+def layered_layout(vertex_ids, edges, sweeps=SWEEPS):
+    """ 返回 {vertex.id: (x, y)}，edges: [(tail, head), ...] """
+    if not vertex_ids:
+        return {}
+    tails = [t for t, _ in edges]
+    heads = [h for _, h in edges]
+    g, ids = CSRGraph.from_ids(vertex_ids, tails, heads)
+    level = levels(g)
+    level[level < 0] = level.max() + 1  # 环上的顶点放到最后一层，只有没检查过的图才会有
+
+    n = g.n
+    t_idx = np.searchsorted(ids, tails).tolist()
+    h_idx = np.searchsorted(ids, heads).tolist()
+    preds = [[] for _ in range(n)]
+    succs = [[] for _ in range(n)]
+    for t, h in zip(t_idx, h_idx):
+        preds[h].append(t)
+        succs[t].append(h)
+
+    layers = [[] for _ in range(int(level.max()) + 1)]
+    for i in np.argsort(level, kind='stable').tolist():  # 初始顺序按顶点 id
+        layers[level[i]].append(i)
+
+    # 位置归一化到 0..1，宽度不同的层之间也可以比较
+    pos = [0.0] * n
+
+    def place(layer):
+        width = len(layer)
+        for k, i in enumerate(layer):
+            pos[i] = (k + 0.5) / width
+
+    for layer in layers:
+        place(layer)
+
+    for sweep in range(sweeps):
+        down = sweep % 2 == 0
+        order = layers[1:] if down else layers[-2::-1]
+        neighbours = preds if down else succs
+        for layer in order:
+            # 没有相邻顶点的保持原位置
+            keys = {i: (sum(pos[j] for j in neighbours[i]) / len(neighbours[i]) if neighbours[i] else pos[i])
+                    for i in layer}
+            layer.sort(key=keys.__getitem__)
+            place(layer)
+
+    coords = {}
+    for y, layer in enumerate(layers):
+        offset = (len(layer) - 1) / 2
+        for k, i in enumerate(layer):
+            coords[int(ids[i])] = ((k - offset) * X_GAP, y * Y_GAP)
+    return coords
+
+
+class Layout:
+    """ 一个图的布局和边，getdag 只需要再查 track """
+
+    def __init__(self, graph_id, positions, edges):
+        self.graph_id = graph_id
+        self.positions = positions  # {vertex.id: (x, y)}
+        self.edges = edges  # [(tail, head), ...]
+
+    @classmethod
+    def load(cls, graph_id):
+        vertex_ids = [v_id for v_id, in db.session.query(Vertex.id).filter(Vertex.graph_id == graph_id)]
+        edges = db.session.query(Edge.tail, Edge.head).filter(Edge.graph_id == graph_id).all()
+        return cls(graph_id, layered_layout(vertex_ids, edges), edges)
+
+
+# graph.id -> 布局，只缓存 sealed 的图
+layouts = TopologyCache(config.LAYOUT_CACHE_SIZE, Layout.load)
+
+
+def get_layout(graph_id, sealed):
+    return layouts.get(graph_id) if sealed else Layout.load(graph_id)
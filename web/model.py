@@ -1,15 +1,15 @@
 # coding: utf-8
-from sqlalchemy import Column, ForeignKey, String, Text, create_engine
-from sqlalchemy.dialects.mysql import INTEGER
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy import Column, ForeignKey, String, Text, DateTime, Index, LargeBinary
+from sqlalchemy.dialects.mysql import INTEGER, LONGBLOB
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.ext.declarative import declarative_base
 from pipeline import config
-from functools import wraps
+from pipeline.model import SessionManager, singleton
 
 """
 这里的 model 是为 WEB 项目的 service 提供数据库支持的，和 pipeline 中的文件一模一样
 如果使用同一个 model 文件，WEB 项目和 Pipeline 项目最好分开使用连接和 session
-这里直接使用了两个
+这里直接使用了两个，连接池和 session 的管理复用 pipeline.model.SessionManager
 """
 
 Base = declarative_base()
@@ -22,6 +22,24 @@ STATE_SUCCEED = 3
 STATE_FAILED = 4
 STATE_FINISH = 5
 
+STATE_NAMES = {
+    STATE_WAITING: 'waiting',
+    STATE_PENDING: 'pending',
+    STATE_RUNNING: 'running',
+    STATE_SUCCEED: 'succeed',
+    STATE_FAILED: 'failed',
+    STATE_FINISH: 'finish',
+}
+
+# track 状态 -> pipeline 表中对应的计数列
+STATE_COUNTERS = {
+    STATE_WAITING: 'tracks_waiting',
+    STATE_PENDING: 'tracks_pending',
+    STATE_RUNNING: 'tracks_running',
+    STATE_SUCCEED: 'tracks_succeed',
+    STATE_FAILED: 'tracks_failed',
+}
+
 
 class Graph(Base):
     __tablename__ = 'graph'
@@ -43,8 +61,9 @@ class Vertex(Base):
     id = Column(INTEGER(11), primary_key=True)
     name = Column(String(45), nullable=False)
     graph_id = Column(ForeignKey('graph.id'), nullable=False, index=True)
-    script = Column(Text)
-    input = Column(Text)
+    # 大字段延迟加载，加载顶点对象时不带出来，用到时才查
+    script = deferred(Column(Text), group='body')
+    input = deferred(Column(Text), group='body')
 
     graph = relationship('Graph')
 
@@ -55,6 +74,9 @@ class Vertex(Base):
 
 class Edge(Base):
     __tablename__ = 'edge'
+    __table_args__ = (
+        Index('ix_edge_graph_head', 'graph_id', 'head'),  # 按图找入度为 0 的顶点
+    )
 
     id = Column(INTEGER(11), primary_key=True)
     tail = Column(ForeignKey('vertex.id'), nullable=False, index=True)
@@ -68,67 +90,67 @@ class Edge(Base):
 
 class Pipeline(Base):
     __tablename__ = 'pipeline'
+    __table_args__ = (
+        Index('ix_pipeline_graph_state', 'graph_id', 'state'),  # 历史记录按图、状态过滤，按 id 翻页
+        Index('ix_pipeline_state', 'state'),
+    )
 
     id = Column(INTEGER(11), primary_key=True)
     graph_id = Column(ForeignKey('graph.id'), nullable=False, index=True)
     name = Column(String(45), nullable=False)
     state = Column(INTEGER(11), nullable=False)
     desc = Column(String(100))
+    priority = Column(INTEGER(11), nullable=False, default=0)  # 越大分到的执行机会越多
+
+    # 各个状态的 track 数，状态变化时增量更新，判断是否结束、查看进度都不用扫 track 表
+    tracks_total = Column(INTEGER(11), nullable=False, default=0)
+    tracks_waiting = Column(INTEGER(11), nullable=False, default=0)
+    tracks_pending = Column(INTEGER(11), nullable=False, default=0)
+    tracks_running = Column(INTEGER(11), nullable=False, default=0)
+    tracks_succeed = Column(INTEGER(11), nullable=False, default=0)
+    tracks_failed = Column(INTEGER(11), nullable=False, default=0)
 
     tracks = relationship('Track', foreign_keys='Track.pipeline_id')
 
 
 class Track(Base):
     __tablename__ = 'track'
+    __table_args__ = (
+        Index('ix_track_pipeline_state', 'pipeline_id', 'state'),  # 一个 pipeline 中某个状态的 track
+        Index('ix_track_state', 'state'),
+    )
 
     id = Column(INTEGER(11), primary_key=True)
     pipeline_id = Column(ForeignKey('pipeline.id'), nullable=False, index=True)
     vertex_id = Column(ForeignKey('vertex.id'), nullable=False, index=True)
     state = Column(INTEGER(11), nullable=False, default=STATE_WAITING)
-    input = Column(Text)
-    script = Column(Text)
-    output = Column(Text)
+    # 大字段延迟加载，列表和状态查询都不需要
+    input = deferred(Column(Text), group='body')
+    script = deferred(Column(Text), group='body')
+    output_digest = Column(String(64))  # 输出压缩后存在 blob 表，这里只存内容的 sha256
+    started_at = Column(DateTime)  # 开始运行的时间
+    ended_at = Column(DateTime)  # 运行结束的时间
+    cached = Column(INTEGER(11), nullable=False, default=0)  # 1 表示直接使用了缓存的运行结果，没有真正运行
 
     vertex = relationship('Vertex')
     pipeline = relationship('Pipeline')
 
 
-def singleton(cls):
-    """ 单实例化 """
-    instance = None
+class Blob(Base):
+    """ 压缩后的 track 输出，按内容寻址，相同的输出只存一份 """
+    __tablename__ = 'blob'
 
-    @wraps(cls)
-    def get_instance(*args, **kwargs):
-        nonlocal instance
-        if not instance:
-            instance = cls(*args, **kwargs)
-        return instance
-
-    return get_instance
+    digest = Column(String(64), primary_key=True)  # 原始内容的 sha256
+    codec = Column(String(8), nullable=False)  # zlib、zstd
+    size = Column(INTEGER(11), nullable=False)  # 原始大小
+    data = deferred(Column(LargeBinary().with_variant(LONGBLOB, 'mysql'), nullable=False))
 
 
 @singleton
-class Database:
+class Database(SessionManager):
     def __init__(self, url, **kwargs):
-        #  Session 类和 engine 都是线程安全的，有一个就行了。所以使用单例化
-        self._engine = create_engine(url, **kwargs)
-        self._session = sessionmaker(bind=self._engine)()  # 在这里把 session 实例化，但是这样在多线程下是不安全的
-
-    @property
-    def session(self):
-        return self._session
-
-    @property
-    def engine(self):
-        return self._engine
-
-    def drop_all(self):
-        # 删除继承自 Base 的所有表
-        Base.metadata.drop_all(self._engine)
-
-    def create_all(self):
-        # 创建继承自 Base 的所有表
-        Base.metadata.create_all(self._engine)
+        # 和 pipeline 的 Database 用法一样，但有自己的 engine 和连接池
+        super().__init__(url, Base.metadata, **kwargs)
 
 
 # 模块加载一次，db也是单例的
@@ -1,48 +1,205 @@
-from .model import db, Pipeline, Track, Vertex, Edge
-import random
+from .model import db, Graph, Pipeline, Track, Vertex, Blob, STATE_NAMES, STATE_COUNTERS
+from pipeline.blob import load_stream, load_text
+from sqlalchemy.orm import load_only
+from pipeline.profiler import profiled
+from .layout import get_layout
+from pipeline.events import hub, relay
+from pipeline import config
+import simplejson
 
 
 # db = getdb() # 如果使用同一个 model 文件，WEB 项目和 Pipeline 项目最好分开使用连接和 session
 
-def randomxy():
-    # 随机模仿 x y坐标
-    return random.randint(300, 500)
-
-
+@profiled('getdag')
 def getdag(pipeline_id):  # 根据 pipeline 的 id 返回流程数据，让前端页面绘制 DAG 图
 
-    ps = db.session.query(Pipeline.id, Pipeline.name, Pipeline.state, Vertex.id, Vertex.name, Vertex.script,
-                          Track.script).join(Track, (Pipeline.id == Track.pipeline_id) & (Pipeline.id == 1)) \
-        .join(Vertex, Vertex.id == Track.vertex_id)
-
-    edges = db.session.query(Edge.tail, Edge.head). \
-        join(Pipeline, (Pipeline.graph_id == Edge.graph_id) & (Pipeline.id == 1))
+    pipeline = db.session.query(Pipeline.name, Pipeline.graph_id, Graph.sealed) \
+        .join(Graph, Graph.id == Pipeline.graph_id) \
+        .filter(Pipeline.id == pipeline_id).one_or_none()
+    if pipeline is None:
+        return None
+    title, graph_id, sealed = pipeline
+    layout = get_layout(graph_id, sealed)  # 分层布局，sealed 的图按图缓存
 
-    print([i for i in ps])
-    print([i for i in edges])
+    # 不取 script，页面需要时用 track 的 id 从 /tracks/<id>?fields=script 单独取
+    ps = db.session.query(Vertex.id, Vertex.name, Track.id, Track.state) \
+        .join(Track, Vertex.id == Track.vertex_id) \
+        .filter(Track.pipeline_id == pipeline_id)
 
     data = []  # 顶点数据
-    vertexes = {}  # 让 edges 查询少 join
-    title = ''
-    for pipeline_id, p_name, p_state, vertex_id, v_name, v_script, t_script in ps:
-        if not title:
-            title = p_name
+    vertexes = {}  # vertex.id -> 名称，边用名称连接
+    for vertex_id, v_name, t_id, t_state in ps:
+        x, y = layout.positions.get(vertex_id, (0, 0))
         data.append({
             'name': v_name,
-            'x': randomxy(),
-            'y': randomxy(),
-            'value': t_script if t_script else v_script
+            'x': x,
+            'y': y,
+            'value': STATE_NAMES.get(t_state),
+            'state': STATE_NAMES.get(t_state),
+            'track': t_id
         })
         vertexes[vertex_id] = v_name
-    print(data)
 
     links = []  # 边
-    for tail, head in edges:
-        print(tail, head)
-        print(vertexes)
-        links.append({
-            'source': vertexes[tail],
-            'target': vertexes[head]
-        })
+    for tail, head in layout.edges:
+        if tail in vertexes and head in vertexes:
+            links.append({
+                'source': vertexes[tail],
+                'target': vertexes[head]
+            })
 
     return {'title': title, 'data': data, 'links': links}
+
+
+def snapshot(pipeline_id):  # pipeline 和所有 track 当前的状态，SSE 连接建立、事件丢失时发送
+    state = db.session.query(Pipeline.state).filter(Pipeline.id == pipeline_id).scalar()
+    if state is None:
+        return None
+    tracks = db.session.query(Track.id, Track.vertex_id, Track.state).filter(Track.pipeline_id == pipeline_id)
+    return {'id': pipeline_id, 'state': STATE_NAMES.get(state),
+            'tracks': [{'id': t_id, 'vertex': v_id, 'state': STATE_NAMES.get(t_state)}
+                       for t_id, v_id, t_state in tracks]}
+
+
+def query(fn, pipeline_id):  # SSE 连接很长，查询完马上归还连接
+    try:
+        return fn(pipeline_id)
+    finally:
+        db.remove()
+
+
+def sse(event, data):
+    return f'event: {event}\ndata: {simplejson.dumps(data)}\n\n'
+
+
+def pipeline_events(pipeline_id):
+    """
+    SSE 事件流，先发一次全量 snapshot，之后只推送状态变化（track、pipeline），pipeline 结束后关闭
+    事件来自执行器写库的线程，本进程中没有执行器时由 EventRelay 从执行器进程转发过来，都不轮询数据库
+    """
+    relay()
+    with hub.subscribe(pipeline_id) as subscription:  # 先订阅再取全量，中间的变化不会丢
+        data = query(snapshot, pipeline_id)
+        if data is None:
+            yield sse('error', {'message': f'pipeline {pipeline_id} 不存在'})
+            return
+        yield sse('snapshot', data)
+        if data['state'] != 'running':
+            return
+
+        while True:
+            event = subscription.get(timeout=config.EVENTS_KEEPALIVE)
+            if subscription.overflow:  # 积压太多或者和执行器断开过，丢了事件，重新发一次全量
+                subscription.overflow = False
+                data = query(snapshot, pipeline_id)
+                if data is None:  # pipeline 被删掉了
+                    return
+                yield sse('snapshot', data)
+                if data['state'] != 'running':
+                    return
+                continue
+            if event is not None:
+                yield sse(event['type'], event)
+                if event['type'] == 'pipeline' and event['state'] != 'running':
+                    return
+                continue
+            yield ': keep-alive\n\n'  # 注释行，让代理和浏览器保持连接
+
+
+STATES = {name: state for state, name in STATE_NAMES.items()}
+TRACK_FIELDS = ('input', 'script', 'output')  # 按需取的大字段
+
+
+def parse_states(value):  # 'failed,finish' 或者 '4,5' -> [4, 5]
+    if not value:
+        return None
+    states = []
+    for item in value.split(','):
+        item = item.strip()
+        if item.isdigit():
+            states.append(int(item))
+        elif item in STATES:
+            states.append(STATES[item])
+        else:
+            raise ValueError(f'未知的状态 {item}')
+    return states
+
+
+def page(query, id_column, before, limit):
+    """
+    按 id 倒序的 keyset 分页，before 是上一页返回的 next，不用 OFFSET，翻到多远都只扫一页
+    多取一行判断还有没有下一页
+    """
+    limit = max(1, min(limit or config.HISTORY_PAGE_SIZE, config.HISTORY_PAGE_MAX))
+    if before:
+        query = query.filter(id_column < before)
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (rows[-1][0] if more else None)
+
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+
+@profiled('list_pipelines')
+def list_pipelines(graph_id=None, states=None, before=None, limit=None):
+    """ pipeline 历史，{'items': [...], 'next': 下一页的 before，没有了为 None}，进度来自计数列，不查 track 表 """
+    counters = [getattr(Pipeline, column) for column in STATE_COUNTERS.values()]
+    query = db.session.query(Pipeline.id, Pipeline.graph_id, Pipeline.name, Pipeline.state, Pipeline.desc,
+                             Pipeline.priority, Pipeline.tracks_total, *counters)
+    if graph_id is not None:
+        query = query.filter(Pipeline.graph_id == graph_id)
+    if states:
+        query = query.filter(Pipeline.state.in_(states))
+    rows, next_id = page(query, Pipeline.id, before, limit)
+    items = [{'id': p_id, 'graph_id': g_id, 'name': name, 'state': STATE_NAMES.get(state), 'desc': desc,
+              'priority': priority, 'total': total,
+              'tracks': {STATE_NAMES[s]: n for s, n in zip(STATE_COUNTERS, counts)}}
+             for p_id, g_id, name, state, desc, priority, total, *counts in rows]
+    return {'items': items, 'next': next_id}
+
+
+@profiled('list_tracks')
+def list_tracks(pipeline_id=None, graph_id=None, states=None, before=None, limit=None):
+    """ track 历史，不带 input、script、output，需要时用 get_track 单独取 """
+    query = db.session.query(Track.id, Track.pipeline_id, Track.vertex_id, Vertex.name, Track.state,
+                             Track.started_at, Track.ended_at) \
+        .join(Vertex, Vertex.id == Track.vertex_id)
+    if pipeline_id is not None:
+        query = query.filter(Track.pipeline_id == pipeline_id)
+    if graph_id is not None:
+        query = query.filter(Vertex.graph_id == graph_id)
+    if states:
+        query = query.filter(Track.state.in_(states))
+    rows, next_id = page(query, Track.id, before, limit)
+    items = [{'id': t_id, 'pipeline_id': p_id, 'vertex_id': v_id, 'vertex': v_name, 'state': STATE_NAMES.get(state),
+              'started_at': isoformat(started_at), 'ended_at': isoformat(ended_at)}
+             for t_id, p_id, v_id, v_name, state, started_at, ended_at in rows]
+    return {'items': items, 'next': next_id}
+
+
+@profiled('get_track')
+def get_track(track_id, fields=()):
+    """ 一个 track 的详情，fields 中列出的大字段（input、script、output）才会查询 """
+    fields = [f for f in TRACK_FIELDS if f in fields]
+    columns = ['pipeline_id', 'vertex_id', 'state', 'started_at', 'ended_at', 'output_digest'] + \
+              [f for f in fields if f != 'output']
+    track = db.session.query(Track).options(load_only(*columns)).filter(Track.id == track_id).one_or_none()
+    if track is None:
+        return None
+    data = {'id': track.id, 'pipeline_id': track.pipeline_id, 'vertex_id': track.vertex_id,
+            'state': STATE_NAMES.get(track.state),
+            'started_at': isoformat(track.started_at), 'ended_at': isoformat(track.ended_at)}
+    for f in fields:
+        if f == 'output':  # 输出压缩存在 blob 表中
+            data[f] = load_text(db.session, Blob.__table__, track.output_digest)
+        else:
+            data[f] = getattr(track, f)
+    return data
+
+
+def track_output(track_id):  # track 结束时保存的输出，返回边解压边产生的 bytes 迭代器，没有返回 None
+    d = db.session.query(Track.output_digest).filter(Track.id == track_id).scalar()
+    return load_stream(db.session, Blob.__table__, d) if d else None